@@ -0,0 +1,147 @@
+"""Measure the bandwidth saved by delta uploads of a partially changed file.
+
+Uploads a file to a local stand-in for the hub's S3 API which rebuilds
+files from delta uploads, then changes a fraction of its blocks and uploads
+it again, with ds.connect(delta_sync=True). Prints the bytes sent and time
+taken by each upload, and checks the stand-in's copy matches. Usage:
+
+    python benchmarks/delta_sync.py [size in MiB] [percent of blocks changed]
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dotscience
+
+
+def apply_delta(base, delta, out):
+    # Rebuild a file from the file objects base (the current copy) and
+    # delta (a body in the DELTA_CONTENT_TYPE format), writing it to out.
+    # This is what the hub does with a delta upload.
+    manifest = json.loads(delta.readline())
+    block_size = manifest["block_size"]
+    base_signature = {"size": 0, "block_size": block_size, "blocks": []}
+    for buf in iter(lambda: base.read(block_size), b""):
+        base_signature["size"] += len(buf)
+        base_signature["blocks"].append(hashlib.sha256(buf).hexdigest())
+    if dotscience._signature_digest(base_signature) != manifest["base"]:
+        raise Exception("Delta doesn't apply to this file")
+    changed = set(manifest["changed"])
+    for i, expected in enumerate(manifest["blocks"]):
+        length = min(block_size, manifest["size"] - i * block_size)
+        if i in changed:
+            buf = delta.read(length)
+        else:
+            base.seek(i * block_size)
+            buf = base.read(length)
+        if hashlib.sha256(buf).hexdigest() != expected:
+            raise Exception("Block %d doesn't match its signature" % (i,))
+        out.write(buf)
+
+
+class FakeDotmeshClient:
+    def __init__(self, cluster_url, username, api_key):
+        pass
+
+    def ping(self):
+        pass
+
+
+class ObjectStore(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    objects = {}
+    received = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = io.BytesIO()
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            body.write(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                return body.getvalue()
+
+    def do_PUT(self):
+        # Clients may send an absolute URI as the request target
+        if "://" in self.path:
+            self.path = "/" + self.path.split("://", 1)[1].split("/", 1)[1]
+        body = self._body()
+        ObjectStore.received += len(body)
+        status = 200
+        applied = False
+        if self.headers.get("Content-Type") == dotscience.DELTA_CONTENT_TYPE:
+            out = io.BytesIO()
+            try:
+                apply_delta(io.BytesIO(self.objects[self.path]), io.BytesIO(body), out)
+                self.objects[self.path] = out.getvalue()
+                applied = True
+            except Exception:
+                status = 409
+        else:
+            self.objects[self.path] = body
+        self.send_response(status)
+        if applied:
+            self.send_header(dotscience.DELTA_APPLIED_HEADER, "applied")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def upload(ds, filename):
+    before = ObjectStore.received
+    t0 = time.perf_counter()
+    ds._upload(filename)
+    return ObjectStore.received - before, time.perf_counter() - t0
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    percent = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ObjectStore)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    dotscience.DotmeshClient = FakeDotmeshClient
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    content = bytearray(os.urandom(size * 1024 * 1024))
+    with open("variables.data", "wb") as f:
+        f.write(content)
+
+    ds = dotscience.Dotscience()
+    ds.connect("bench", "bench", "bench", "http://127.0.0.1:%d" % (server.server_address[1],), delta_sync=True)
+    ds._cached_project = {"id": "0123456789abcdef"}
+
+    sent, elapsed = upload(ds, "variables.data")
+    print("first upload:  %10d bytes sent in %.2fs" % (sent, elapsed))
+
+    block_size = ds._delta_block_size
+    blocks = len(content) // block_size
+    for i in random.sample(range(blocks), max(1, int(blocks * percent / 100))):
+        content[i * block_size] ^= 0xff
+    with open("variables.data", "wb") as f:
+        f.write(content)
+
+    sent, elapsed = upload(ds, "variables.data")
+    print("second upload: %10d bytes sent in %.2fs (%.1f%% of the file, %.1f%% of blocks changed)" % (
+        sent, elapsed, 100.0 * sent / len(content), percent))
+    [stored] = ObjectStore.objects.values()
+    assert stored == content, "the stand-in's copy doesn't match"
+    print("stand-in's copy matches")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Compare the throughput of the plain and zero-copy single file upload paths.
+
+Uploads a file to a local HTTP server which throws the body away, with
+ds.connect(zero_copy=False) and then zero_copy=True, and prints the bytes/sec
+each managed. Usage:
+
+    python benchmarks/upload_throughput.py [size in MiB] [repeats]
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import dotscience
+
+
+class FakeDotmeshClient:
+    def __init__(self, cluster_url, username, api_key):
+        pass
+
+    def ping(self):
+        pass
+
+
+def sink_server():
+    # Reads each request body and answers 200, over keep-alive connections
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def serve(conn):
+        try:
+            serve_requests(conn)
+        except ConnectionError:
+            pass
+
+    def serve_requests(conn):
+        f = conn.makefile("rb")
+        while True:
+            length = None
+            line = f.readline()
+            if not line:
+                return
+            while line not in (b"\r\n", b""):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+                line = f.readline()
+            remaining = length or 0
+            while remaining:
+                remaining -= len(f.read(min(remaining, 1024 * 1024)))
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return "http://127.0.0.1:%d" % (listener.getsockname()[1],)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    url = sink_server()
+    dotscience.DotmeshClient = FakeDotmeshClient
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    with open("model.bin", "wb") as f:
+        for _ in range(size):
+            f.write(os.urandom(1024 * 1024))
+
+    for zero_copy in [False, True]:
+        ds = dotscience.Dotscience()
+        ds.connect("bench", "bench", "bench", url, zero_copy=zero_copy)
+        ds._cached_project = {"id": "0123456789abcdef"}
+        ds._upload("model.bin")  # warm up the page cache and connection
+        best = None
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            ds._upload("model.bin")
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        print("zero_copy=%-5s %8.1f MiB/s" % (zero_copy, size / best))
+
+    os.remove("model.bin")
+    os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
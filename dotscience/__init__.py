@@ -14,21 +14,268 @@ import string
 import tarfile
 import tempfile
 import joblib
+import copy
+import fnmatch
+import requests.adapters
+import concurrent.futures
+import hashlib
+import http.client
+import base64
+import threading
+import xml.etree.ElementTree
+import collections
+import mmap
+import zlib
+import asyncio
+import functools
+import socket
+import socketserver
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from dotmesh.client import DotmeshClient, DotName
+from jsonrpcclient.exceptions import ReceivedNon2xxResponseError
 
 ENV_DOTSCIENCE_BUILDER = 'DOTSCIENCE_BUILDER'
 
+UPLOAD_MODES = ["archive", "stream", "files"]
+
+# Output files are read and sent in pieces of this size when streaming, so
+# memory use stays bounded no matter how big the model is.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Records what was last uploaded from this workspace, see ds.connect(dedupe=True)
+UPLOAD_MANIFEST_FILE = ".dotscience-uploads.json"
+
+# Records the parts of multipart uploads the hub has acknowledged so far, so
+# an interrupted upload can be resumed
+MULTIPART_STATE_FILE = ".dotscience-multipart.json"
+
+# Compressed archives are made of independently compressed blocks of this
+# size (concatenated gzip members or zstd frames), so all cores can help
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+# The levels tried on the first block when picking one automatically
+COMPRESSION_LEVELS = {
+    "gzip": [1, 3, 6, 9],
+    "zstd": [1, 3, 9, 15],
+}
+
+# Where we keep the block signatures of files as we last uploaded them, see
+# ds.connect(delta_sync=True)
+DELTA_SIGNATURES_DIR = ".dotscience-signatures"
+
+# Runs that couldn't be published because the hub was unreachable, one JSON
+# file per run, waiting for ds.flush_spool() (see ds.connect(spool=True))
+SPOOL_DIR = ".dotscience-spool"
+
+# How long the publisher daemon waits for more runs to arrive before
+# committing the ones it has been handed (see PublisherDaemon)
+PUBLISHER_BATCH_WINDOW = 0.2
+
+# Projects we've looked up on any hub, shared by every process run by this
+# user (see ds.connect(project_cache_ttl=...)). Relative to the user's cache
+# directory.
+PROJECT_CACHE_FILE = os.path.join("dotscience", "projects.json")
+
+# Images we've had built, by the fingerprint of the model they were built
+# from (see ds.connect(build_cache=...)). Also relative to the user's cache
+# directory.
+BUILD_CACHE_FILE = os.path.join("dotscience", "builds.json")
+
+# Which deployer gets the next new deployment, when none of them report
+# their load (see _pick_deployer)
+DEPLOYER_TURNS_FILE = os.path.join("dotscience", "deployers.json")
+
+# A delta upload's body is one line of JSON describing the new file:
+#
+#   {"version": 1, "base": <_signature_digest of the hub's current copy>,
+#    "size": <new size>, "block_size": <block size>,
+#    "blocks": [<sha256 of each block of the new file>, ...],
+#    "changed": [<index of each block that differs from the current copy>, ...]}
+#
+# followed by the contents of each changed block, in order. Every other
+# block is the same as the block at the same offset in the current copy.
+DELTA_CONTENT_TYPE = "application/vnd.dotscience.delta+json"
+
+# Hubs that applied a delta say so in this response header. A 2xx without it
+# may just mean the hub stored the delta body as the file.
+DELTA_APPLIED_HEADER = "X-Dotscience-Delta"
+
+# How soon to first check again on something we're waiting for on the hub
+# (see _wait_for); the wait doubles each time after that.
+POLL_MIN_INTERVAL = 0.05
+
+class _MultipartUploadGone(Exception):
+    pass
+
+# Responses worth trying again besides 5xx: the hub is busy (e.g. 423 Locked
+# while Jupyter holds the dot) or wants us to slow down
+RETRYABLE_STATUSES = [408, 423, 425, 429]
+
+class HubUnavailable(RuntimeError):
+    """Raised instead of calling the Dotscience Hub while it's failing, see
+    breaker_threshold in connect()."""
+
+class _HubError(Exception):
+    # An unsuccessful response from the hub
+    def __init__(self, what, status, body, retryable=None):
+        super().__init__("Error %s: %s %s" % (what, status, body))
+        self.status = status
+        self.body = body
+        if retryable is None:
+            retryable = status >= 500 or status in RETRYABLE_STATUSES
+        self.retryable = retryable
+
+class _RetryPolicy:
+    """Retries calls to the hub with exponential backoff and jitter.
+
+    Transport errors talking to the hub and retryable statuses (see
+    _HubError) are retried, up to `attempts` tries; anything else, including
+    local errors such as a missing file, is raised straight away. Once
+    `breaker_threshold` tries in a row have failed, the hub is assumed to be
+    down and calls fail fast with HubUnavailable for `breaker_cooldown`
+    seconds, rather than every upload worker waiting out its own retries.
+    What happened is counted in `counters`.
+    """
+
+    def __init__(self, attempts=10, backoff=1.0, max_backoff=10.0, breaker_threshold=20, breaker_cooldown=30.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = None
+
+    def check(self):
+        # Raise HubUnavailable if the breaker is open
+        with self._lock:
+            if self._open_until is not None and time.time() < self._open_until:
+                self.counters["short_circuited"] += 1
+                raise HubUnavailable("Not calling the Dotscience Hub for another %d seconds, after %d failures in a row" % (
+                    self._open_until - time.time(), self._failures))
+
+    def _record(self, ok):
+        with self._lock:
+            if ok:
+                self._failures = 0
+                self._open_until = None
+                return
+            self.counters["failures"] += 1
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                # Trip, or (after a failed try once the cooldown is over)
+                # trip again
+                self.counters["breaker_opened"] += 1
+                self._open_until = time.time() + self.breaker_cooldown
+
+    def call(self, what, fn, attempts=None, retryable=None):
+        """Call fn() until it returns, and return what it returned. what
+        describes the call for error messages, e.g. "uploading model.pkl".
+        retryable, if given, is called with each error and says whether
+        it's safe to try again, for calls that mustn't be repeated if they
+        might have reached the hub."""
+        attempts = attempts or self.attempts
+        delay = self.backoff
+        for attempt in range(1, attempts + 1):
+            self.check()
+            with self._lock:
+                self.counters["calls"] += 1
+            try:
+                result = fn()
+            except (_HubError, requests.RequestException, http.client.HTTPException,
+                    ConnectionError, socket.timeout, socket.gaierror) as e:
+                if isinstance(e, _HubError) and not e.retryable:
+                    # The hub's fine, it just doesn't like this request
+                    self._record(True)
+                    raise
+                self._record(False)
+                if isinstance(e, _HubError):
+                    _print_hub_error(what, e.status, e.body)
+                else:
+                    print("Error %s: %s" % (what, e))
+                if attempt == attempts or (retryable is not None and not retryable(e)):
+                    with self._lock:
+                        self.counters["gave_up"] += 1
+                    if attempt == 1:
+                        raise
+                    raise Exception("%s didn't succeed after retrying %d times: %s" % (what, attempt, e)) from e
+                wait = random.uniform(delay / 2, delay)
+                print("Waiting %.1f seconds and trying again..." % (wait,))
+                with self._lock:
+                    self.counters["retries"] += 1
+                time.sleep(wait)
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                self._record(True)
+                return result
+
+class _OutputPolicy:
+    # Which files under an output path get published. Glob patterns are
+    # matched against both the path relative to the output and the file or
+    # directory's own name, so exclude="__pycache__" prunes every
+    # __pycache__ directory and include="*.pb" picks out every .pb file.
+
+    def __init__(self, include=None, exclude=None, max_file_size=None, max_total_size=None):
+        if isinstance(include, str):
+            include = [include]
+        if isinstance(exclude, str):
+            exclude = [exclude]
+        self.include = include
+        self.exclude = exclude or []
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+
+    @staticmethod
+    def _matches(rel, patterns):
+        name = os.path.basename(rel)
+        return any(fnmatch.fnmatch(rel, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+    def excludes(self, rel):
+        return self._matches(rel, self.exclude)
+
+    def accepts_file(self, rel, full_path):
+        if self.include is not None and not self._matches(rel, self.include):
+            return False
+        if self.max_file_size is not None and os.path.getsize(full_path) > self.max_file_size:
+            return False
+        return True
+
+    def check_total(self, what, root, files):
+        if self.max_total_size is None:
+            return
+        total = sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        if total > self.max_total_size:
+            raise RuntimeError('The files in %s add up to %d bytes, more than the max_total_size of %d' % (what, total, self.max_total_size))
+
+def _output_policy(include=None, exclude=None, max_file_size=None, max_total_size=None):
+    if include is None and exclude is None and max_file_size is None and max_total_size is None:
+        return None
+    return _OutputPolicy(include, exclude, max_file_size, max_total_size)
+
 # Paths will be relative to root, not necessarily cwd
-def _add_output_path(root, nameset, path):
+def _add_output_path(root, nameset, path, policies=(), top=None):
     full_path = os.path.join(root, path)
+    if top is None:
+        top = path
+    rel = os.path.relpath(path, top) if path != top else os.path.basename(path)
+
+    if path != top and any(p.excludes(rel) for p in policies):
+        # Don't even look inside excluded directories
+        return
 
     if os.path.isdir(full_path):
         ents = os.listdir(full_path)
         for ent in ents:
             fn = os.path.join(path, ent)
-            _add_output_path(root, nameset, fn)
-    else:
+            _add_output_path(root, nameset, fn, policies, top)
+    elif all(p.accepts_file(rel, full_path) for p in policies):
         nameset.add(path)
 
 class Run:
@@ -38,6 +285,8 @@ class Run:
         self._description = None
         self._inputs = set()
         self._outputs = set()
+        self._output_policies = {}
+        self._publish_policy = None
         self._labels = {}
         self._metric = {}
         self._parameters = {}
@@ -47,32 +296,43 @@ class Run:
         self._mode = None
         self._root = root
         self._model_dir = None
+        # What metadata() last returned, until something changes it
+        self._metadata = None
+
+    def _changed(self):
+        self._metadata = None
 
     def _set_workload_file(self, workload_file):
         self._workload_file = workload_file
+        self._changed()
 
     def start(self):
         if self._start == None:
             self._start = datetime.datetime.utcnow()
+            self._changed()
         else:
             raise RuntimeError('Run.start() has been called more than once')
 
     def lazy_start(self):
         if self._start == None:
             self._start = datetime.datetime.utcnow()
+            self._changed()
 
     def forget_times(self):
         self._end = None
         self._start = None
+        self._changed()
 
     def end(self):
         # Only the first end() is kept, as the system does one at the
         # end, but that shouldn't override one the user has done.
         if self._end == None:
             self._end = datetime.datetime.utcnow()
+            self._changed()
 
     def set_error(self, error):
         self._error = str(error)
+        self._changed()
 
     def error(self, error):
         self.set_error(error)
@@ -80,6 +340,7 @@ class Run:
 
     def set_description(self, description):
         self._description = str(description)
+        self._changed()
 
     def description(self, description):
         self.set_description(description)
@@ -88,6 +349,7 @@ class Run:
     def add_input_file(self, filename):
         filename_str = os.path.relpath(str(filename),start=self._root)
         self._inputs.add(filename_str)
+        self._changed()
 
     def add_input(self, filename):
         if os.path.isdir(filename):
@@ -110,20 +372,34 @@ class Run:
     # add_input because it's called BEFORE the output happens - the
     # files might not exist yet.  So expansion happens in metadata()
     # below!
-    def add_output(self, filename):
+    #
+    # include and exclude are glob patterns (or lists of them) choosing
+    # which files under a directory are published; files bigger than
+    # max_file_size bytes are left out, and publishing fails if the files
+    # add up to more than max_total_size bytes.
+    def add_output(self, filename, include=None, exclude=None, max_file_size=None, max_total_size=None):
         filename_str = os.path.relpath(str(filename),start=self._root)
         self._outputs.add(filename_str)
+        self._output_policies[filename_str] = _output_policy(include, exclude, max_file_size, max_total_size)
+        self._changed()
 
-    def add_outputs(self, *args):
+    def add_outputs(self, *args, **kwargs):
         for filename in args:
-            self.add_output(filename)
+            self.add_output(filename, **kwargs)
 
-    def output(self, filename):
-        self.add_output(filename)
+    def output(self, filename, **kwargs):
+        self.add_output(filename, **kwargs)
         return filename
 
+    # Applies to every output at publish time, on top of what was passed
+    # to add_output
+    def set_output_policy(self, include=None, exclude=None, max_file_size=None, max_total_size=None):
+        self._publish_policy = _output_policy(include, exclude, max_file_size, max_total_size)
+        self._changed()
+
     def add_label(self, label, value):
         self._labels[str(label)] = str(value)
+        self._changed()
 
     # Supports any combination of ("a", "val of a", "b", "val of b") and (c="val of c")
     def add_labels(self, *args, **kwargs):
@@ -149,6 +425,8 @@ class Run:
         if artefact_type not in artefact_types:
             raise RuntimeError('Unknown model type %s' % (artefact_type,))
 
+        policy = {k: kwargs[k] for k in ("include", "exclude", "max_file_size", "max_total_size") if k in kwargs}
+
         labels = {"type": artefact_type}
         files = {}
         return_value = None
@@ -161,7 +439,7 @@ class Run:
 
         relative_files = {}
         for key in files:
-            self.add_output(files[key])
+            self.add_output(files[key], **(policy if key == "model" else {}))
             relative_files[key] = os.path.relpath(str(files[key]),start=self._root)
         labels["files"] = relative_files
 
@@ -175,6 +453,7 @@ class Run:
 
     def add_metric(self, label, value):
         self._metric[str(label)] = str(value)
+        self._changed()
 
     # Supports any combination of ("a", "val of a", "b", "val of b") and (c="val of c")
     def add_metrics(self, *args, **kwargs):
@@ -196,6 +475,7 @@ class Run:
 
     def add_parameter(self, label, value):
         self._parameters[str(label)] = str(value)
+        self._changed()
 
     # Supports any combination of ("a", "val of a", "b", "val of b") and (c="val of c")
     def add_parameters(self, *args, **kwargs):
@@ -210,7 +490,23 @@ class Run:
         self.add_parameter(label, value)
         return value
 
+    def _expand_output(self, o):
+        policies = [p for p in (self._output_policies.get(o), self._publish_policy) if p is not None]
+        files = set()
+        _add_output_path(self._root, files, o, policies)
+        return files
+
     def metadata(self):
+        # Walking big output directories is slow and publishing needs the
+        # metadata several times, so it's worked out once and kept until
+        # something is added to the run. Files written to output
+        # directories since then aren't noticed, so publish() calls
+        # _changed() to start afresh.
+        if self._metadata is None:
+            self._metadata = self._make_metadata()
+        return dict(self._metadata)
+
+    def _make_metadata(self):
         # We expanded input directories on the way in, because we
         # expect the files to exist before add_input is called; but we
         # only expand output directories here at the end, because we
@@ -218,7 +514,12 @@ class Run:
 
         expanded_outputs = set()
         for o in self._outputs:
-            _add_output_path(self._root, expanded_outputs, o)
+            files = self._expand_output(o)
+            if self._output_policies.get(o) is not None:
+                self._output_policies[o].check_total(o, self._root, files)
+            expanded_outputs |= files
+        if self._publish_policy is not None:
+            self._publish_policy.check_total("this run's outputs", self._root, expanded_outputs)
 
         r = {
             "version": "1",
@@ -249,6 +550,26 @@ class Run:
     def newID(self):
         self._id = str(uuid.uuid4())
 
+    @classmethod
+    def _from_metadata(cls, root, run_id, metadata, model_dir):
+        # Rebuild a run from what metadata() returned, e.g. from the spool.
+        # Outputs were expanded (and filtered) then, so are kept as they are.
+        run = cls(root)
+        run._id = run_id
+        run._inputs = set(metadata["input"])
+        run._outputs = set(metadata["output"])
+        run._labels = metadata["labels"]
+        run._metric = metadata["summary"]
+        run._parameters = metadata["parameters"]
+        run._error = metadata.get("error")
+        run._description = metadata.get("description")
+        run._workload_file = metadata.get("workload-file")
+        run._model_dir = model_dir
+        for k in ("start", "end"):
+            if k in metadata:
+                setattr(run, "_" + k, datetime.datetime.strptime(metadata[k], "%Y%m%dT%H%M%S.%f"))
+        return run
+
     # used by the Dotscience lib to determine where the model is saved
     def getModelDir(self):
         return self._model_dir
@@ -262,29 +583,327 @@ class Run:
         # FIXME: Do something a bit nicer
         print (json.dumps(self.metadata(), sort_keys=True, indent=4))
 
+class PublishFuture:
+    """A run being published in the background, as returned by
+    publish(wait=False).
+
+    state is the name of the stage the publish has got to: "queued",
+    "uploading", "committing", "committed", "building", "built",
+    "deploying", "deployed", "waiting", then "done" or "failed" (or
+    "spooled", see connect(spool=True)). The run URL, image, endpoint and
+    dashboard are filled in as they become known.
+    result() waits for the publish to finish and returns what publish()
+    would have returned, or raises what it would have raised.
+
+    The list of output files is fixed when publish() is called, but their
+    contents are read while the run is uploaded, so don't overwrite them
+    until the publish is done.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.state = "queued"
+        self.run = None
+        self.image = None
+        self.endpoint = None
+        self.dashboard = None
+        self._future = concurrent.futures.Future()
+
+    def _progress(self, state, **results):
+        self.state = state
+        for k, v in results.items():
+            setattr(self, k, v)
+
+    def done(self):
+        return self._future.done()
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self._future.exception(timeout)
+
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda f: fn(self))
+
+    def __repr__(self):
+        return "<PublishFuture run_id=%s state=%s>" % (self.run_id, self.state)
+
+class PublisherDaemon:
+    """Publishes runs for every training process on a machine.
+
+    Dotscience objects connected with publisher_socket=path hand their runs
+    to the daemon listening there instead of publishing them themselves, so
+    the processes share one set of hub connections and project lookups,
+    output files they all produce are only uploaded once (see
+    connect(dedupe=True)), runs handed over within batch_window seconds of
+    each other are committed together, and tarring and uploading happens
+    here rather than in the processes doing the training. Processes which
+    can't reach the daemon publish their runs themselves.
+
+    root is the workspace the runs' output files are in, and should be the
+    daemon's working directory; runs from anywhere else are handed back.
+    connect_options are passed to connect() for each hub, user and project
+    the daemon publishes to.
+
+    Requests are a line of JSON holding the run (see
+    Dotscience._spool_entry), the workspace it was recorded in and the API
+    key to publish it with. The reply is a line of JSON with the "result"
+    of publishing it or an "error", and "fallback": true if the run wasn't
+    touched and the client should publish it itself. The socket is only
+    accessible to the user running the daemon, as requests carry API keys.
+    """
+
+    def __init__(self, path, root=".", batch_window=PUBLISHER_BATCH_WINDOW, **connect_options):
+        self.path = path
+        self.root = os.path.realpath(root)
+        self.batch_window = batch_window
+        self._connect_options = dict({"dedupe": True}, **connect_options)
+        # Not even if $DOTSCIENCE_PUBLISHER_SOCKET says so
+        self._connect_options["publisher_socket"] = ""
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._queue = []
+        self._queued = threading.Condition()
+        self._closed = False
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode("utf-8"))
+                    reply = daemon._handle(request)
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"fallback": True, "error": "bad request: %s: %s" % (type(e).__name__, e)}
+                self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+        if os.path.exists(path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(path)
+        # Requests carry API keys, so the socket mustn't be reachable by
+        # anyone else, even for the moment between creating and chmodding it
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+        self._batcher = threading.Thread(target=self._batch, daemon=True)
+        self._batcher.start()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._queued:
+            self._closed = True
+            self._queued.notify()
+        self._batcher.join()
+        self._pool.shutdown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _handle(self, request):
+        entry = request["run"]
+        if request["root"] != self.root:
+            return {"fallback": True, "error": "runs from %s can't be published by a daemon serving %s" % (request["root"], self.root)}
+        future = concurrent.futures.Future()
+        with self._queued:
+            if self._closed:
+                return {"fallback": True, "error": "the daemon is shutting down"}
+            self._queue.append(((entry["hub"], entry["user"], request["apikey"], entry["project"]), entry, future))
+            self._queued.notify()
+        try:
+            return {"result": future.result()}
+        except Exception as e:
+            return {"error": "%s: %s" % (type(e).__name__, e)}
+
+    def _batch(self):
+        while True:
+            with self._queued:
+                while not self._queue and not self._closed:
+                    self._queued.wait()
+                if not self._queue:
+                    return
+            # Give the other processes' runs a chance to arrive, so they can
+            # go in the same commit
+            time.sleep(self.batch_window)
+            with self._queued:
+                batch, self._queue = self._queue, []
+            batches = collections.OrderedDict()
+            for key, entry, future in batch:
+                batches.setdefault(key, []).append((entry, future))
+            for key, items in batches.items():
+                self._pool.submit(self._publish, key, items)
+
+    def _publish(self, key, items):
+        try:
+            # Each run is handed to us once, by the process that recorded
+            # it, so there's no need to ask the hub whether it has them
+            results = self._client(key)._publish_entries([entry for (entry, future) in items], check_published=False)
+        except Exception as e:
+            results = [e] * len(items)
+        for (entry, future), result in zip(items, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            elif result is None:
+                future.set_exception(RuntimeError("run %s has already been published" % (entry["run_id"],)))
+            else:
+                future.set_result(result)
+
+    def _client(self, key):
+        with self._clients_lock:
+            if key not in self._clients:
+                hub, user, apikey, project = key
+                ds = Dotscience()
+                ds.connect(user, apikey, project, hub, lazy=True, **self._connect_options)
+                ds._root = self.root
+                self._clients[key] = ds
+            return self._clients[key]
+
+class _ModelIndex:
+    """The id of the model made by each run, as far as we've seen from the
+    hub's /v2/models. Shared by everything publishing to the same hub as the
+    same user in this process, see _model_index().
+
+    We ask the hub for just the model for the run we're looking for. Hubs
+    that can't do that send all of them, in which case we remember them
+    all, and the list's ETag so that we only get it again if it's changed.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.etag = None
+        self._lock = threading.Lock()
+
+    def find(self, ds, run_id):
+        # The model id for run_id, or None if the hub doesn't know it yet
+        with self._lock:
+            if run_id in self.models:
+                return self.models[run_id]
+            headers = {}
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            resp = ds._hub_request("looking up model for run %s" % (run_id,), "GET", ds._hostname+"/v2/models",
+                                   attempts=1, ok=(304,), params={"run_id": run_id}, headers=headers)
+            if resp.status_code == 304:
+                return None
+            models = resp.json()
+            if any(model["run_id"] != run_id for model in models):
+                # The hub ignored run_id, so this is the whole list
+                self.etag = resp.headers.get("ETag")
+            for model in models:
+                self.models[model["run_id"]] = model["id"]
+            return self.models.get(run_id)
+
+_model_indexes = {}
+_model_indexes_lock = threading.Lock()
+
+def _model_index(hostname, username):
+    with _model_indexes_lock:
+        return _model_indexes.setdefault((hostname, username), _ModelIndex())
+
 class Dotscience:
     currentRun = None
 
     def __init__(self):
+        # Background publishes outlive reconnecting, so these aren't in _reset
+        self._publisher = None
+        self._async_publisher = None
+        # The _manifest_entry of each output file we've fingerprinted, so
+        # files that haven't changed aren't hashed again
+        self._file_hashes = {}
         self._reset()
 
     def _reset(self):
+        if getattr(self, "_watcher", None) is not None:
+            self._watcher.stop()
+        self._watcher = None
+        # Reconnecting starts a fresh pool of connections to the hub
+        if getattr(self, "_session", None) is not None:
+            self._session.close()
+        for conn in getattr(self, "_upload_connections", []):
+            conn.close()
         self._mode = None
         self._workload_file = None
         self._root = os.getenv('DOTSCIENCE_PROJECT_DOT_ROOT', default=os.getcwd())
         self._dotmesh_client = None
+        self._warm_up = None
+        self._branches = {}
         self._hostname = None
         self._auth = None
         self._cached_project = None
+        self._project_cache_ttl = 24 * 60 * 60
+        self._spool = False
+        self._publisher_socket = None
+        self._project_lock = threading.Lock()
         self._project_name = None
-        self._deployment = None
-        self._deployer = None
-
-    def connect(self, username, apikey, project, hostname):
+        self._upload_mode = "archive"
+        self._upload_workers = 4
+        self._dedupe = False
+        self._manifest_lock = threading.Lock()
+        self._session = None
+        self._upload_connections = []
+        self._pool_size = 10
+        self._timeout = None
+        self._upload_timeout = None
+        self._multipart_threshold = None
+        self._multipart_part_size = 16 * 1024 * 1024
+        self._multipart_lock = threading.RLock()
+        self._upload_shards = 1
+        self._compression = None
+        self._compression_level = None
+        self._upload_bandwidth = 12.5 * 1000 * 1000
+        self._zero_copy = True
+        self._delta_sync = False
+        self._hub_takes_deltas = True
+        self._delta_block_size = 1024 * 1024
+        self._publish_workers = 1
+        self._async_publish_workers = 16
+        self._build_timeout = 600
+        self._deploy_timeout = 120
+        self._poll_max_interval = 5.0
+        self._status_subscribe = False
+        self._build_cache = True
+        self._replicas = 1
+        self._resource_requests = {}
+        self._autoscaling = None
+        self._retry = _RetryPolicy()
+
+    def connect(self, username, apikey, project, hostname, upload_mode="archive", upload_workers=4, dedupe=False,
+                pool_size=None, timeout=120, upload_timeout=None, multipart_threshold=None, multipart_part_size=16 * 1024 * 1024,
+                upload_shards=1, compression=None, compression_level=None, upload_bandwidth=12.5 * 1000 * 1000,
+                zero_copy=True, eager_upload=False, eager_upload_interval=2.0,
+                delta_sync=False, delta_block_size=1024 * 1024, publish_workers=1, async_publish_workers=16,
+                build_timeout=600, deploy_timeout=120, poll_max_interval=5.0, status_subscribe=False,
+                retry_attempts=10, retry_backoff=1.0, breaker_threshold=20, breaker_cooldown=30.0,
+                project_cache_ttl=24 * 60 * 60, lazy=False, spool=False,
+                publisher_socket=None, build_cache=True, replicas=1, cpu_request=None, memory_request=None,
+                min_replicas=None, max_replicas=None, target_cpu_utilization=None):
         # TODO: Make this fail if we're in a mode other than 'remote' mode.
         # TODO: make publish etc fail if we're not connected in remote mode.
         if not project:
             raise Exception("Please specify a project name as the third argument to ds.connect()")
+        if upload_mode not in UPLOAD_MODES:
+            raise RuntimeError('Unknown upload mode %r, expected one of %s' % (upload_mode, UPLOAD_MODES))
+        if upload_workers < 1:
+            raise RuntimeError('upload_workers must be at least 1, got %r' % (upload_workers,))
+        if upload_shards < 1:
+            raise RuntimeError('upload_shards must be at least 1, got %r' % (upload_shards,))
+        if compression not in COMPRESSION_LEVELS and compression is not None:
+            raise RuntimeError('Unknown compression %r, expected one of %s' % (compression, sorted(COMPRESSION_LEVELS)))
+        if replicas < 1:
+            raise RuntimeError('replicas must be at least 1, got %r' % (replicas,))
+        if (min_replicas is None) != (max_replicas is None):
+            raise RuntimeError('min_replicas and max_replicas must be given together, got %r and %r' % (min_replicas, max_replicas))
+        if min_replicas is not None and not 1 <= min_replicas <= max_replicas:
+            raise RuntimeError('Expected 1 <= min_replicas <= max_replicas, got %r and %r' % (min_replicas, max_replicas))
+        if target_cpu_utilization is not None and min_replicas is None:
+            raise RuntimeError('target_cpu_utilization needs min_replicas and max_replicas')
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package, try: pip install zstandard')
         self._reset()
         self._dotmesh_client = DotmeshClient(
             cluster_url=hostname + "/v2/dotmesh/rpc",
@@ -295,9 +914,144 @@ class Dotscience:
         self._mode = "remote"
         self._auth = (username, apikey)
         self._project_name = project
-        print("Checking connection... ", end="")
-        result = self._dotmesh_client.ping()
-        print("connected!")
+        self._upload_mode = upload_mode
+        self._upload_workers = upload_workers
+        self._dedupe = dedupe
+        self._timeout = timeout
+        self._upload_timeout = upload_timeout
+        self._multipart_threshold = multipart_threshold
+        self._multipart_part_size = multipart_part_size
+        self._upload_shards = upload_shards
+        self._compression = compression
+        self._compression_level = compression_level
+        self._upload_bandwidth = upload_bandwidth
+        self._zero_copy = zero_copy
+        self._delta_sync = delta_sync
+        self._delta_block_size = delta_block_size
+        self._publish_workers = publish_workers
+        self._async_publish_workers = async_publish_workers
+        self._build_timeout = build_timeout
+        self._deploy_timeout = deploy_timeout
+        self._poll_max_interval = poll_max_interval
+        self._status_subscribe = status_subscribe
+        self._build_cache = build_cache
+        self._replicas = replicas
+        self._resource_requests = {k: v for k, v in (("cpu", cpu_request), ("memory", memory_request)) if v is not None}
+        if min_replicas is not None:
+            self._autoscaling = {"min_replicas": min_replicas, "max_replicas": max_replicas}
+            if target_cpu_utilization is not None:
+                self._autoscaling["target_cpu_utilization"] = target_cpu_utilization
+            # Start within the bounds
+            self._replicas = min(max(replicas, min_replicas), max_replicas)
+        self._project_cache_ttl = project_cache_ttl
+        self._spool = spool
+        if publisher_socket is None:
+            publisher_socket = os.getenv("DOTSCIENCE_PUBLISHER_SOCKET")
+        self._publisher_socket = publisher_socket
+        self._retry = _RetryPolicy(
+            attempts=retry_attempts,
+            backoff=retry_backoff,
+            breaker_threshold=breaker_threshold,
+            breaker_cooldown=breaker_cooldown,
+        )
+        # One keep-alive connection pool for every call we make to the hub,
+        # big enough that concurrent uploads don't have to queue for it.
+        # _upload manages its own http.client connections (see the comment
+        # there), which are pooled in self._upload_connections.
+        self._pool_size = pool_size or max(10, upload_workers, upload_shards)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self._pool_size,
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        if lazy:
+            # Check the connection and look things up in the background, and
+            # have publishing wait for that (see _join_warm_up)
+            self._warm_up = concurrent.futures.Future()
+            threading.Thread(target=self._warm_up_connection, args=(self._warm_up,), daemon=True).start()
+        else:
+            print("Checking connection... ", end="")
+            self._dotmesh_call("checking the connection", self._dotmesh_client.ping)
+            print("connected!")
+        if eager_upload:
+            self._watcher = _OutputWatcher(self, eager_upload_interval)
+
+    def _warm_up_connection(self, done):
+        try:
+            self._warm_up_now()
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
+
+    def _warm_up_now(self):
+        self._dotmesh_call("checking the connection", self._dotmesh_client.ping)
+        project = self._get_project_or_create(self._project_name)
+        self._master_branch(f"project-{project['id'][:8]}-default-workspace")
+
+    def _join_warm_up(self):
+        # Wait for connect(lazy=True)'s warm-up. If it failed, e.g. because
+        # the hub was down for a moment, forget about it and try again here,
+        # so we only fail if the hub still can't be reached
+        warm_up = self._warm_up
+        if warm_up is None or warm_up.exception() is None:
+            return
+        print("Connecting to the hub failed earlier (%s), trying again" % (warm_up.exception(),))
+        self._warm_up_now()
+        self._warm_up = None
+
+    def _master_branch(self, dotName):
+        # Dotmesh handle for the branch runs are committed to, looked up
+        # once per dot
+        if dotName not in self._branches:
+            self._branches[dotName] = self._dotmesh_call(
+                "looking up %s" % (dotName,),
+                lambda: self._dotmesh_client.getDot(dotname=dotName, ns=self._auth[0]).getBranch("master"))
+        return self._branches[dotName]
+
+    def _dotmesh_call(self, what, fn, retryable=None):
+        # Make Dotmesh RPCs through the retry policy, like other hub calls
+        # (see _RetryPolicy.call for retryable)
+        def attempt():
+            try:
+                return fn()
+            except ReceivedNon2xxResponseError as e:
+                raise _HubError(what, e.code, b"") from e
+        return self._retry.call(what, attempt, retryable=retryable)
+
+    def hub_stats(self):
+        """Counts of what's happened calling the Dotscience Hub since
+        connect(): calls, failures, retries, gave_up (calls that failed
+        after all their retries), breaker_opened (times we stopped calling
+        the hub because it kept failing) and short_circuited (calls not made
+        because of that)."""
+        stats = dict.fromkeys(["calls", "failures", "retries", "gave_up", "breaker_opened", "short_circuited"], 0)
+        stats.update(self._retry.counters)
+        return stats
+
+    def _hub_request(self, what, method, url, attempts=None, ok=(), body=None, timeout=None, **kwargs):
+        # Make a request to the hub through the session and retry policy,
+        # returning the response if it's a success or its status is in ok.
+        # body, if given, makes the request body afresh for each try.
+        # timeout is passed on to requests, and defaults to connect(timeout).
+        if timeout is None:
+            timeout = self._timeout
+        def attempt():
+            if body is not None:
+                kwargs["data"] = body()
+            resp = self._session.request(method, url, auth=self._auth, timeout=timeout, **kwargs)
+            if resp.status_code >= 300 and resp.status_code not in ok:
+                raise _HubError(what, resp.status_code, resp.content)
+            return resp
+        return self._retry.call(what, attempt, attempts)
+
+    async def aconnect(self, username, apikey, project, hostname, **kwargs):
+        # connect() only blocks on pinging the hub, so do that on a thread
+        # rather than on the caller's event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.connect, username, apikey, project, hostname, **kwargs))
 
     def interactive(self):
         if self._mode == None or self._mode == "interactive":
@@ -331,32 +1085,20 @@ class Dotscience:
         # record the start time of the first thing after the publish
         self.currentRun.lazy_start()
 
-    def publish(self, description=None, stream=sys.stdout, build=False, deploy=False):
-        if self._mode == None:
-            runMode = os.getenv("DOTSCIENCE_WORKLOAD_TYPE", "")
-            if runMode == "jupyter":
-                self.interactive()
-            elif runMode == "command":
-                self.script()
-        self._check_started()
-
-        # end() will set the end timestamp, if the user hasn't already
-        # done so manually
-        self.currentRun.end()
-
-        if description != None:
-            self.currentRun.set_description(description)
-
-        self.currentRun._set_workload_file(self._workload_file)
-
-        # Generate a new ID on every publish(), so you never get multiple runs
-        # with the same id but potentially different parameters ending up in
-        # metadata. That confuses the Dotscience UI very badly as it makes it
-        # impossible to distinguish different runs by ID.
-        self.currentRun.newID()
+    def publish(self, description=None, stream=sys.stdout, build=False, deploy=False,
+                include=None, exclude=None, max_file_size=None, max_total_size=None, wait=True):
+        self._start_publish(description, include, exclude, max_file_size, max_total_size)
 
         ret = None
-        if self._mode == "remote":
+        if self._mode == "remote" and not wait:
+            # Publish a copy of the run as it is now in the background, so
+            # the caller can get on with the next one. Working out its
+            # metadata here fixes which output files it publishes; their
+            # contents are only read when the upload gets to them.
+            snapshot = copy.deepcopy(self.currentRun)
+            snapshot.metadata()
+            ret = self._publish_in_background(snapshot, build, deploy)
+        elif self._mode == "remote":
             # In remote mode, we need to push output files (i.e. models) to the
             # remote dotscience hub via the S3 api, then construct the run
             # metadata ourselves and create a dotmesh commit.
@@ -365,12 +1107,15 @@ class Dotscience:
             # decouple the run storage from dotmesh commit metadata (the
             # gateway will soon have a separate runs database which will
             # support streaming multi-epoch runs).
-            ret = self._publish_remote_run(build, deploy)
+            ret = self._publish_or_spool(self.currentRun, build, deploy)
         else:
             # In jupyter and command mode, we just write the current run out as
             # JSON (into a notebook or stdout, respectively) to get picked by
             # the agent's committer
             stream.write(str(self.currentRun) + "\n")
+            if not wait:
+                ret = PublishFuture(None)
+                ret._future.set_result(None)
 
         # After publishing, reset the start and end time so that we don't end
         # up with multiple runs with the same times (calling end() twice has no
@@ -382,189 +1127,928 @@ class Dotscience:
         self.currentRun.forget_times()
         return ret
 
-    def _publish_remote_run(self, build, deploy):
-        ret = {}
-        print("\n=== Dotscience remote publish ===\n")
-        # - Upload output files via S3 API in a tar stream
-        # TODO: maybe don't upload all output files, only ones tagged as model?
+    def _start_publish(self, description, include, exclude, max_file_size, max_total_size):
+        # Finish off the current run, ready for publishing it
+        if self._mode == None:
+            runMode = os.getenv("DOTSCIENCE_WORKLOAD_TYPE", "")
+            if runMode == "jupyter":
+                self.interactive()
+            elif runMode == "command":
+                self.script()
+        self._check_started()
 
-        self._get_project_or_create(self._project_name, verbose=True)
+        # end() will set the end timestamp, if the user hasn't already
+        # done so manually
+        self.currentRun.end()
 
-        print("*  Uploading output/model files\n", end="")
-        self._upload_output_files()
-        # - Craft the commit metadata for the run and call the Commit() API
-        #   directly on dotmesh on the hub
-        run = self._commit_run_on_hub()
-        ret["run"] = ret
-        print(" done")
-        print("   -> Dotscience run: %s\n" % (run,))
+        if description != None:
+            self.currentRun.set_description(description)
 
-        # NB: deploy=True implies build=True
-        if build or deploy:
-            # - Build
+        self.currentRun._set_workload_file(self._workload_file)
+        self.currentRun.set_output_policy(include, exclude, max_file_size, max_total_size)
+
+        # Generate a new ID on every publish(), so you never get multiple runs
+        # with the same id but potentially different parameters ending up in
+        # metadata. That confuses the Dotscience UI very badly as it makes it
+        # impossible to distinguish different runs by ID.
+        self.currentRun.newID()
+        # Output files may have been written since metadata() was last
+        # called, so look at them afresh for this publish
+        self.currentRun._changed()
+
+    async def apublish(self, description=None, stream=sys.stdout, build=False, deploy=False,
+                       include=None, exclude=None, max_file_size=None, max_total_size=None):
+        if self._mode != "remote":
+            return self.publish(description, stream, build, deploy, include, exclude, max_file_size, max_total_size)
+        # Copying the run before this first awaits is all that happens on
+        # the event loop. Working out which files to publish, the uploads,
+        # hub calls and build/deploy polling all happen on a pool of their
+        # own (see async_publish_workers), so the loop is free to start
+        # other publishes, which run at the same time as this one.
+        self._start_publish(description, include, exclude, max_file_size, max_total_size)
+        snapshot = copy.deepcopy(self.currentRun)
+        self.currentRun.forget_times()
+        if self._async_publisher is None:
+            self._async_publisher = concurrent.futures.ThreadPoolExecutor(max_workers=self._async_publish_workers)
+        handle = self._publish_in_background(snapshot, build, deploy, self._async_publisher)
+        return await asyncio.wrap_future(handle._future)
+
+    def _publish_in_background(self, run, build, deploy, executor=None):
+        # Publish run on executor, by default the pool of publish_workers
+        if executor is None:
+            if self._publisher is None:
+                self._publisher = concurrent.futures.ThreadPoolExecutor(max_workers=self._publish_workers)
+            executor = self._publisher
+        handle = PublishFuture(run._id)
+        def publish():
+            try:
+                # Find the output files, if the caller hasn't already
+                run.metadata()
+                return self._publish_or_spool(run, build, deploy, handle._progress)
+            except Exception:
+                handle._progress("failed")
+                raise
+        handle._future = executor.submit(publish)
+        return handle
+
+    def _publish_or_spool(self, run, build, deploy, progress=None):
+        # Publish run, or if we've been asked to spool runs and the hub
+        # can't be reached before the run is committed, save it in the
+        # spool for flush_spool() to publish later
+        if self._publisher_socket:
+            if progress is not None:
+                progress("uploading")
+            ret = self._publish_with_daemon(run, build, deploy)
+            if ret is not None:
+                if progress is not None:
+                    progress("done", **{k: ret[k] for k in ("run", "image", "endpoint", "dashboard") if k in ret})
+                return ret
+        if not self._spool:
+            return self._publish_remote_run(run, build, deploy, progress)
+        committed = []
+        def watch(state, **results):
+            if state == "committed":
+                committed.append(results["run"])
+            if progress is not None:
+                progress(state, **results)
+        try:
+            return self._publish_remote_run(run, build, deploy, watch)
+        except Exception as e:
+            if committed or not _hub_unreachable(e):
+                raise
+            path = self._spool_run(run, build, deploy)
+            print("Couldn't reach the Dotscience Hub (%s), saved the run in %s for ds.flush_spool() to publish" % (e, path))
+            if progress is not None:
+                progress("spooled")
+            return {"spooled": path}
+
+    def _publish_with_daemon(self, run, build, deploy):
+        # Hand run to the PublisherDaemon listening on publisher_socket.
+        # Returns None if there isn't one, or it won't take the run, so we
+        # should publish it ourselves.
+        request = {
+            "root": os.path.realpath(self._root),
+            "apikey": self._auth[1],
+            "run": self._spool_entry(run, build, deploy),
+        }
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._publisher_socket)
+        except OSError as e:
+            sock.close()
+            print("No publisher daemon at %s (%s), publishing the run from this process" % (self._publisher_socket, e))
+            return None
+        print("\n=== Handing run %s to the publisher daemon at %s ===\n" % (run._id, self._publisher_socket))
+        with sock, sock.makefile("rwb") as f:
+            f.write(json.dumps(request).encode("utf-8") + b"\n")
+            f.flush()
+            line = f.readline()
+        if not line:
+            # It may or may not have committed the run, so we mustn't
+            # publish it again
+            raise RuntimeError("The publisher daemon at %s went away while publishing run %s" % (self._publisher_socket, run._id))
+        reply = json.loads(line.decode("utf-8"))
+        if reply.get("fallback"):
+            print("The publisher daemon won't publish this run (%s), publishing it from this process" % (reply["error"],))
+            return None
+        if "error" in reply:
+            raise RuntimeError("The publisher daemon couldn't publish run %s: %s" % (run._id, reply["error"]))
+        ret = reply["result"]
+        print("   -> Dotscience run: %s" % (ret["run"],))
+        return ret
+
+    def _spool_entry(self, run, build, deploy):
+        # Everything needed to publish run from another process, see
+        # flush_spool and PublisherDaemon
+        return {
+            "version": 1,
+            "hub": self._hostname,
+            "user": self._auth[0],
+            "project": self._project_name,
+            "run_id": run._id,
+            "spooled": time.time(),
+            "metadata": run.metadata(),
+            "model_dir": run.getModelDir(),
+            "workload_file": run._workload_file or sys.argv[0],
+            "build": build,
+            "deploy": deploy,
+        }
+
+    def _spool_run(self, run, build, deploy):
+        path = os.path.join(self._root, SPOOL_DIR, run._id + ".json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _save_spool_entry(path, self._spool_entry(run, build, deploy))
+        return path
+
+    def flush_spool(self):
+        """Publish the runs saved in the spool because the hub couldn't be
+        reached (see connect(spool=True)), returning what publishing each
+        of them returned.
+
+        The runs' outputs are uploaded one run at a time, and then all the
+        runs are committed together. Runs the hub already has, e.g. because
+        an earlier flush was interrupted after committing them, are just
+        removed from the spool. Runs which were committed but couldn't be
+        built or deployed are left in the spool, marked as committed, and
+        flushing them again only retries building and deploying them.
+        """
+        self._join_warm_up()
+        spool = os.path.join(self._root, SPOOL_DIR)
+        entries = []
+        for name in sorted(os.listdir(spool)) if os.path.isdir(spool) else []:
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(spool, name)) as f:
+                entry = json.load(f)
+            if (entry["hub"], entry["user"], entry["project"]) != (self._hostname, self._auth[0], self._project_name):
+                print("Leaving run %s in the spool, it's for project %s on %s" % (entry["run_id"], entry["project"], entry["hub"]))
+                continue
+            entries.append((os.path.join(spool, name), entry))
+        entries.sort(key=lambda e: e[1]["spooled"])
+        if not entries:
+            return []
+
+        def committed(i, url):
+            # Note the commit straight away, so that however the rest of the
+            # flush goes, the run isn't committed again
+            path, entry = entries[i]
+            entry["committed"] = url
+            _save_spool_entry(path, entry)
+
+        rets = []
+        failed = None
+        results = self._publish_entries([entry for (path, entry) in entries], on_commit=committed)
+        for (path, entry), ret in zip(entries, results):
+            if isinstance(ret, Exception):
+                print("Leaving run %s in the spool: %s" % (entry["run_id"], ret))
+                failed = failed or ret
+                continue
+            os.remove(path)
+            if ret is not None:
+                rets.append(ret)
+        if failed is not None:
+            raise failed
+        return rets
+
+    def _publish_entries(self, entries, check_published=True, on_commit=None):
+        # Publish runs saved by _spool_entry: upload each one's outputs,
+        # commit them all together, then build and deploy the ones that
+        # asked for it. Entries with the URL of the run in "committed" are
+        # only built and deployed. on_commit, if given, is called with the
+        # index and URL of each entry as soon as it has been committed.
+        # Returns, for each entry, what publishing it returned or the
+        # exception that stopped it, or None if the hub already had the
+        # run. Raises if the commit fails, as then none of them have been
+        # published.
+        project = self._get_project_or_create(self._project_name, verbose=True)
+        branch = self._master_branch(f"project-{project['id'][:8]}-default-workspace")
+        published = set()
+        if check_published and not all(entry.get("committed") for entry in entries):
+            for c in self._dotmesh_call("listing commits", branch.log) or []:
+                published.update(json.loads((c.get("Metadata") or {}).get("runs", "[]")))
+
+        results = [None] * len(entries)
+        pending = []
+        builds = []
+        for i, entry in enumerate(entries):
+            run = Run._from_metadata(self._root, entry["run_id"], entry["metadata"], entry["model_dir"])
+            run._set_workload_file(entry["workload_file"])
+            if entry.get("committed"):
+                print("Run %s has already been committed" % (entry["run_id"],))
+                results[i] = {"run": entry["committed"]}
+                if entry["build"] or entry["deploy"]:
+                    builds.append((i, entry, run, entry["committed"]))
+                continue
+            if entry["run_id"] in published:
+                print("Run %s has already been published" % (entry["run_id"],))
+                continue
+            print("*  Uploading output/model files of run %s\n" % (run._id,), end="")
+            try:
+                results[i] = self._upload_output_files(run)
+            except Exception as e:
+                results[i] = e
+                continue
+            pending.append((i, entry, run))
+
+        if pending:
+            print("*  Committing %d runs" % (len(pending),))
+            urls = self._commit_runs_on_hub([run for (i, entry, run) in pending])
+        else:
+            urls = []
+        for (i, entry, run), url in zip(pending, urls):
+            if on_commit is not None:
+                on_commit(i, url)
+            results[i]["run"] = url
+            print("   -> Dotscience run: %s" % (url,))
+            if entry["build"] or entry["deploy"]:
+                builds.append((i, entry, run, url))
+        if builds:
+            # Builds mostly wait on the hub, so do them all at once
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(builds)) as pool:
+                futures = [
+                    (i, pool.submit(self._publish_remote_run, run, entry["build"], entry["deploy"], committed=url))
+                    for (i, entry, run, url) in builds
+                ]
+                for i, future in futures:
+                    try:
+                        results[i].update(future.result())
+                    except Exception as e:
+                        results[i] = e
+        return results
+
+    def _publish_remote_run(self, run, build, deploy, progress=None, committed=None):
+        # progress, if given, is called with the name of each stage as it
+        # starts, and with the results as they become available. If the run
+        # has already been uploaded and committed (see flush_spool), pass
+        # its URL as committed to just build and deploy it.
+        if progress is None:
+            progress = lambda state, **results: None
+        print("\n=== Dotscience remote publish ===\n")
+        started = time.time()
+        self._join_warm_up()
+
+        # Each stage starts as soon as the stages it needs have finished, so
+        # the project is looked up while the outputs are tarred, deployers
+        # are found during the build, and the Grafana dashboard is set up
+        # while we wait for the endpoint to become active.
+        def upload(results):
+            # - Upload output files via S3 API in a tar stream
+            # TODO: maybe don't upload all output files, only ones tagged as model?
+            print("*  Uploading output/model files\n", end="")
+            progress("uploading")
+            try:
+                return self._upload_output_files(run)
+            except _HubError as e:
+                if e.status != 404:
+                    raise
+            # The project we had cached is gone, so find it again
+            print("Project %s not found on the hub, looking it up again" % (self._project_name,))
+            self._forget_project()
+            return self._upload_output_files(run)
+
+        def commit(results):
+            # - Craft the commit metadata for the run and call the Commit() API
+            #   directly on dotmesh on the hub
+            progress("committing")
+            runURL = self._commit_run_on_hub(run)
+            progress("committed", run=runURL)
+            print("   -> Dotscience run: %s\n" % (runURL,))
+            return runURL
+
+        def build_image(results):
             print("*  Building docker image...", end="")
             sys.stdout.flush()
-            image = self._build_docker_image_on_hub()
-            ret["image"] = image
+            progress("building")
+            image = self._build_docker_image_on_hub(run)
+            progress("built", image=image)
             print(" done")
             print("   -> Docker image: %s\n" % (image,))
-        if deploy:
-            # - Deploy to Kubernetes
+            return image
+
+        def deploy_image(results):
             print("*  Deploying to Kubernetes... ", end="")
             sys.stdout.flush()
-            endpoint = self._deploy_to_kube()
-            ret["endpoint"] = endpoint
-            print("done")
+            progress("deploying")
+            deploying = time.time()
+            deployer, existing = results["deployer"]
+            deployer, deployment, existing = self._deploy_to_kube(run, results["build"], deployer, existing)
+            endpoint = self._get_deployment_url(deployment["host"]) + ":predict"
+            progress("deployed", endpoint=endpoint)
+            print("updated" if existing else "done")
             print("   -> Endpoint: %s\n" % (endpoint,))
-            # - Set up Grafana dashboard
-            print("*  Creating Grafana dashboard... ", end="")
-            sys.stdout.flush()
-            dashboard = self._setup_grafana()
-            ret["dashboard"] = dashboard
-            print("done")
+            return deploying, deployment, existing
+
+        def dashboard(results):
+            deploying, deployment, existing = results["deploy"]
+            deployer, _ = results["deployer"]
+            dashboard = self._setup_grafana(deployer, deployment, existing)
+            progress("waiting", dashboard=dashboard)
             print("   -> Dashboard: %s\n" % (dashboard,))
+            return dashboard
 
+        def wait_active(results):
             print("Waiting for model endpoint to become active", end="")
             sys.stdout.flush()
-            self._wait_active()
+            progress("waiting")
+            deploying, deployment, existing = results["deploy"]
+            self._wait_active(deployment)
+            # From asking for the deployment to the endpoint answering
+            serving = time.time() - deploying
             print(" done")
+            print("   -> Serving %.1fs after deploying\n" % (serving,))
+            return serving
 
-        print("=== Dotscience publish complete ===\n")
+        stages = {
+            "project": ((), lambda results: self._get_project_or_create(self._project_name, verbose=True)),
+            "upload": ((), upload),
+            "commit": (("project", "upload"), commit),
+        }
+        if committed is not None:
+            stages = {
+                "upload": ((), lambda results: {}),
+                "commit": ((), lambda results: committed),
+            }
+        # NB: deploy=True implies build=True
+        if build or deploy:
+            stages["build"] = (("commit",), build_image)
+        if deploy:
+            stages["deployer"] = ((), lambda results: self._find_deployer())
+            stages["deploy"] = (("build", "deployer"), deploy_image)
+            stages["dashboard"] = (("deploy",), dashboard)
+            stages["wait_active"] = (("deploy",), wait_active)
+        results, timings = _run_stages(stages)
+
+        ret = results["upload"]
+        ret["run"] = results["commit"]
+        if "build" in results:
+            ret["image"] = results["build"]
+        if "deploy" in results:
+            deploying, deployment, existing = results["deploy"]
+            ret["endpoint"] = self._get_deployment_url(deployment["host"]) + ":predict"
+            ret["dashboard"] = results["dashboard"]
+            ret["deployment"] = "updated" if existing else "created"
+            ret["time_to_serving"] = results["wait_active"]
+        timings["total"] = time.time() - started
+        ret["timings"] = timings
+        print("=== Dotscience publish complete (%.1fs) ===\n" % (timings["total"],))
+        progress("done")
         return ret
 
-    def _tar_outputFiles(self, tarFileName):
-        dirPrefix = self.currentRun.getModelDir() + "/"
+    def _tar_outputFiles(self, run, tarFileName, files):
+        dirPrefix = run.getModelDir() + "/"
         # TODO: upload them all in one go, using PUT tarball API, once
         # https://github.com/dotmesh-io/dotmesh/issues/754 is implemented
         
         tar = tarfile.open(tarFileName, "w:")
-        for f in self.currentRun.metadata()["output"]:
+        for f in files:
             # removing model dir prefix so we can cleanly
             # upload files (removing previous dir such as 'model/' before extracting this one)
             tar.add(f, arcname=remove_prefix(f, dirPrefix))
         tar.close()
 
-    def _upload_output_files(self):
-        outputFileSize = len(self.currentRun.metadata()["output"])
+    def _upload_output_files(self, run):
+        outputs = run.metadata()["output"]
+        stats = {"uploaded_bytes": 0, "skipped_bytes": 0}
+
+        background = set()
+        if self._watcher is not None:
+            # Wait for any background uploads still in flight; files they
+            # sent which haven't changed since needn't be sent again
+            background = self._watcher.wait_uploaded(outputs)
+            stats["background_bytes"] = sum(os.path.getsize(f) for f in background)
+
+        manifest = None
+        if self._dedupe:
+            # Only send files whose content differs from what we last
+            # uploaded to this dot
+            manifest = self._load_upload_manifest()
+            changed = []
+            for f in outputs:
+                previous = manifest.get(f)
+                manifest[f] = _manifest_entry(f, previous)
+                if f in background:
+                    continue
+                if previous and previous["sha256"] == manifest[f]["sha256"]:
+                    stats["skipped_bytes"] += manifest[f]["size"]
+                else:
+                    changed.append(f)
+            outputs = changed
+        outputs = [f for f in outputs if f not in background]
+        stats["uploaded_bytes"] = sum(os.path.getsize(f) for f in outputs)
+        outputFileSize = len(outputs)
+        
+        if outputFileSize > 1 and self._upload_mode == "files":
+            # PUT each file on its own, several at a time, which suits
+            # models made of lots of small files better than one tar
+            self._uploadConcurrently(outputs)
+        elif outputFileSize > 1 and self._upload_shards > 1:
+            # Split the files into several archives which are packed and
+            # uploaded at the same time
+            stats.update(self._uploadShards(run, outputs))
+        elif outputFileSize > 1:
+            stats.update(self._uploadArchiveFiles(run, outputs))
+        elif outputFileSize == 1:
+            self._upload(outputs[0])
+
+        if manifest is not None:
+            self._save_upload_manifest(manifest)
         
-        if outputFileSize > 1:
-            temp = tempfile.NamedTemporaryFile(delete=False)
-            temp.close()
+        print(".\n", end="")
+        sys.stdout.flush()
+        return stats
+
+    def _uploadArchiveFiles(self, run, files):
+        # Returns the archive's size before and after compression, if it
+        # was compressed
+        path = run.getModelDir()
+        sizes = {}
+        if self._upload_mode == "stream":
+            # Stream the tar straight into the request body, so nothing
+            # is staged on local disk
+            self._uploadArchiveStream(files, path, sizes)
+            return sizes
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.close()
+        try:
             # 1. Tar the files in the model dir
-            self._tar_outputFiles(temp.name)
+            if self._compression:
+                with open(temp.name, 'wb') as f:
+                    for buf in self._archive_stream(files, path, sizes):
+                        f.write(buf)
+            else:
+                self._tar_outputFiles(run, temp.name, files)
             # 2. Upload the tar
             # Uploading to the same model dir so we get proper paths
             # such as /model/assets/saved_model.json
-            self._uploadArchive(temp.name, self.currentRun.getModelDir())
+            self._uploadArchive(temp.name, path)
+        finally:
             os.remove(temp.name)
-        elif outputFileSize == 1:
-            self._upload(self.currentRun.metadata()["output"][0])
-        
-        print(".\n", end="")
-        sys.stdout.flush()
+        return sizes
+
+    def _uploadShards(self, run, files):
+        # Every shard is extracted into the same path, so the result on the
+        # hub is the same as for a single archive. The first failure is
+        # raised once the other shards have finished.
+        shards = _balanced_shards(files, self._upload_shards)
+        totals = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            for sizes in pool.map(lambda shard: self._uploadArchiveFiles(run, shard), shards):
+                for k, v in sizes.items():
+                    totals[k] = totals.get(k, 0) + v
+        return totals
+
+    def _upload_manifest_key(self):
+        project = self._get_project_or_create(self._project_name)
+        dotName = f"project-{project['id'][:8]}-default-workspace"
+        return f"{self._hostname}/{self._auth[0]}:{dotName}"
+
+    def _load_upload_manifest(self):
+        # The manifest lives in the workspace root and holds, per dot, the
+        # size, mtime and sha256 of every output file we last uploaded.
+        try:
+            with open(os.path.join(self._root, UPLOAD_MANIFEST_FILE)) as f:
+                manifests = json.load(f)
+        except (OSError, ValueError):
+            manifests = {}
+        return manifests.get(self._upload_manifest_key(), {})
+
+    def _save_upload_manifest(self, manifest):
+        path = os.path.join(self._root, UPLOAD_MANIFEST_FILE)
+        # Runs published at the same time (see PublisherDaemon) each add
+        # the files they uploaded to what's there, rather than overwriting
+        # each other's
+        key = self._upload_manifest_key()
+        with self._manifest_lock:
+            try:
+                with open(path) as f:
+                    manifests = json.load(f)
+            except (OSError, ValueError):
+                manifests = {}
+            manifests.setdefault(key, {}).update(manifest)
+            # Write then rename, so a crash can't leave a truncated manifest
+            with open(path + ".tmp", "w") as f:
+                json.dump(manifests, f, sort_keys=True, indent=4)
+            os.replace(path + ".tmp", path)
 
     def _get_project_or_create(self, project_name, verbose=False):
+        # Publish stages look the project up concurrently; only one of them
+        # should go to the hub (and maybe create it)
+        with self._project_lock:
+            return self._get_project_or_create_locked(project_name, verbose)
+
+    def _get_project_or_create_locked(self, project_name, verbose):
         if self._cached_project:
             return self._cached_project
-
-        projects = requests.get(self._hostname+"/v2/projects", auth=self._auth)
+        project = self._load_cached_project(project_name)
+        if project is not None:
+            self._cached_project = project
+            return project
+
+        # Hubs that can look a project up by name just send that one back;
+        # others ignore the query and send them all
+        projects = self._hub_request("listing projects", "GET", self._hostname+"/v2/projects", params={"name": project_name})
         for project in projects.json():
             if project["name"] == project_name:
                 self._cached_project = project
+                self._save_cached_project(project_name, project)
                 if verbose:
                     print("Found project %s.\n" % (project_name,))
                 return project
         else:
-            new = requests.post(self._hostname+"/v2/projects", auth=self._auth, json={"name": project_name})
+            new = self._hub_request("creating project %s" % (project_name,), "POST", self._hostname+"/v2/projects",
+                                    attempts=1, json={"name": project_name})
             self._cached_project = new.json()
+            self._save_cached_project(project_name, self._cached_project)
             if verbose:
                 print("Created new project %s as it did not exist.\n" % (project_name,))
             return new.json()
 
+    def _forget_project(self):
+        # The hub doesn't know the project we had cached (e.g. it's been
+        # deleted), so look it up again next time
+        with self._project_lock:
+            self._cached_project = None
+            self._save_cached_project(self._project_name, None)
+
+    def _project_cache_key(self, project_name):
+        return "%s %s %s" % (self._hostname, self._auth[0], project_name)
+
+    def _load_cached_project(self, project_name):
+        if not self._project_cache_ttl:
+            return None
+        entry = _read_user_cache(PROJECT_CACHE_FILE).get(self._project_cache_key(project_name))
+        if entry is None:
+            return None
+        if time.time() - entry["time"] > self._project_cache_ttl:
+            return None
+        return entry["project"]
+
+    def _save_cached_project(self, project_name, project):
+        # Pass project=None to forget about it
+        if not self._project_cache_ttl:
+            return
+        key = self._project_cache_key(project_name)
+        def update(projects):
+            if project is None:
+                return projects.pop(key, None) is not None
+            projects[key] = {"project": project, "time": time.time()}
+            return True
+        _update_user_cache(PROJECT_CACHE_FILE, update)
+
+    def _build_cache_key(self, fingerprint):
+        return "%s %s %s" % (self._hostname, self._auth[0], fingerprint)
+
+    def _cached_build(self, fingerprint):
+        # The image of a completed build of a model with this fingerprint,
+        # if we've had one built and the hub still has it
+        entry = _read_user_cache(BUILD_CACHE_FILE).get(self._build_cache_key(fingerprint))
+        if entry is None:
+            return None
+        path = f"/v2/models/{entry['model_id']}/builds/{entry['build_id']}"
+        resp = self._hub_request("getting %s" % (path,), "GET", self._hostname+path, ok=(404,))
+        if resp.status_code == 404 or resp.json().get("status") != "completed":
+            self._save_cached_build(fingerprint, None)
+            return None
+        return entry["image"]
+
+    def _save_cached_build(self, fingerprint, entry):
+        # Pass entry=None to forget about it
+        key = self._build_cache_key(fingerprint)
+        def update(builds):
+            if entry is None:
+                return builds.pop(key, None) is not None
+            builds[key] = entry
+            return True
+        _update_user_cache(BUILD_CACHE_FILE, update)
+
     def _upload(self, filename):
+        if self._delta_sync:
+            return self._upload_delta(filename)
+        return self._upload_whole(filename)
+
+    def _upload_delta(self, filename):
+        # Upload only the blocks of filename that have changed since we last
+        # uploaded it, going by the block signatures we kept from then. The
+        # whole file is sent when there's nothing to compare against, or
+        # the hub can't take a delta against its copy.
         project = self._get_project_or_create(self._project_name)
         dotName = f"project-{project['id'][:8]}-default-workspace"
-        attempt = 0
-        while attempt < 10:
-            attempt += 1
+        url = self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{filename}"
+        signature = _block_signature(filename, self._delta_block_size)
+        base = self._load_block_signature(url)
+        sent = False
+        if self._hub_takes_deltas and base is not None and base["block_size"] == signature["block_size"]:
+            changed = [i for i, h in enumerate(signature["blocks"]) if base["blocks"][i:i+1] != [h]]
+            if len(changed) < len(signature["blocks"]):
+                sent = self._put_delta(url, filename, base, signature, changed)
+        if not sent:
+            self._upload_whole(filename)
+        st = os.stat(filename)
+        if (st.st_size, st.st_mtime_ns) == (signature["size"], signature["mtime"]):
+            self._save_block_signature(url, signature)
+        else:
+            # It changed under us, so we don't know what the hub has got
+            self._save_block_signature(url, None)
+
+    def _put_delta(self, url, filename, base, signature, changed):
+        # Returns whether the hub took the delta
+        manifest = json.dumps({
+            "version": 1,
+            "base": _signature_digest(base),
+            "size": signature["size"],
+            "block_size": signature["block_size"],
+            "blocks": signature["blocks"],
+            "changed": changed,
+        }).encode("utf-8") + b"\n"
+        def body():
+            yield manifest
             with open(filename, 'rb') as f:
-                # workaround https://github.com/psf/requests/issues/2422 - unable
-                # to see response code when body isn't fully consumed due to error
-                # (e.g. 423 Locked)
-                import http
-                from base64 import b64encode
-
-                userAndPass = b64encode((f"{self._auth[0]}:{self._auth[1]}").encode("ascii")).decode("ascii")
-                headers = { 'Authorization' : 'Basic %s' %  userAndPass }
-
-                scheme, hostname = self._hostname.split("://")
-                if scheme == "http":
-                    conn = http.client.HTTPConnection(hostname)
-                elif scheme == "https":
-                    conn = http.client.HTTPSConnection(hostname)
-                else:
-                    raise Exception("Unsupported scheme %s", scheme)
+                for i in changed:
+                    f.seek(i * signature["block_size"])
+                    yield f.read(signature["block_size"])
+        # 4xx and 501 mean the hub doesn't take deltas, or its copy isn't
+        # the one our signature describes
+        refused = (400, 404, 409, 412, 415, 501)
+        resp = self._hub_request("uploading changes to %s" % (filename,), "PUT", url, ok=refused, body=body,
+                                 headers={"Content-Type": DELTA_CONTENT_TYPE})
+        if resp.status_code in refused:
+            print("Hub refused changes to %s (%s), uploading all of it" % (filename, resp.status_code))
+            return False
+        if resp.headers.get(DELTA_APPLIED_HEADER) != "applied":
+            # The hub didn't understand the delta, and may have stored it as
+            # the file; uploading all of it puts that right. Don't bother it
+            # with deltas again.
+            print("Hub didn't apply changes to %s, uploading all of it" % (filename,))
+            self._hub_takes_deltas = False
+            return False
+        return True
+
+    def _block_signature_path(self, url):
+        return os.path.join(self._root, DELTA_SIGNATURES_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _load_block_signature(self, url):
+        try:
+            with open(self._block_signature_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_block_signature(self, url, signature):
+        # Pass signature=None to forget about url
+        path = self._block_signature_path(url)
+        if signature is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(signature, f)
+        os.replace(path + ".tmp", path)
+
+    def _upload_whole(self, filename):
+        if self._multipart_threshold is not None and os.path.getsize(filename) >= self._multipart_threshold:
+            return self._upload_multipart(filename)
+        project = self._get_project_or_create(self._project_name)
+        dotName = f"project-{project['id'][:8]}-default-workspace"
+        # workaround https://github.com/psf/requests/issues/2422 - unable
+        # to see response code when body isn't fully consumed due to error
+        # (e.g. 423 Locked)
+        userAndPass = base64.b64encode((f"{self._auth[0]}:{self._auth[1]}").encode("ascii")).decode("ascii")
+        headers = { 'Authorization' : 'Basic %s' %  userAndPass }
+        url = self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{filename}"
+
+        def attempt():
+            while True:
+                conn, reused = self._upload_connection()
+                with open(filename, 'rb') as f:
+                    try:
+                        if self._zero_copy and not isinstance(conn, http.client.HTTPSConnection):
+                            _put_file_zero_copy(conn, url, f, headers)
+                        else:
+                            conn.request("PUT", url, f, headers)
+                    except Exception as e:
+                        # The hub may have answered (e.g. 423 Locked) and hung
+                        # up before we finished sending, so still read the
+                        # response
+                        print("Error uploading %s: %s" % (filename, e))
+                    try:
+                        # Storing a big file can take the hub longer than
+                        # timeout, so wait for its answer for upload_timeout
+                        if conn.sock is not None:
+                            conn.sock.settimeout(self._upload_timeout)
+                        resp = conn.getresponse()
+                        body = resp.read()
+                    except Exception:
+                        self._release_upload_connection(conn, False)
+                        if reused:
+                            # The hub closed the idle keep-alive connection
+                            # under us, just try again on a fresh one
+                            continue
+                        raise
+                self._release_upload_connection(conn, not resp.will_close)
+                if resp.status >= 300:
+                    raise _HubError("uploading %s" % (filename,), resp.status, body)
+                return
 
-                try:
-                    R = conn.request(
-                        "PUT",
-                        self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{filename}",
-                        f,
-                        headers, # {"Content-Type": "application/json", "Accept": "application/json"},
-                    )
-                    # Success, return - otherwise we'll retry
-                    return
-                except Exception as e:
-                    print("Error uploading %s: %s" % (filename, e))
-                    new_R = conn.getresponse()
-                    print("Response code:", new_R.status)
-                    if new_R.status == 423:
-                        print("--> Try stopping Jupyter within Dotscience or wait "
-                             "for the lock owner (e.g. task ID) listed below to finish, then try again")
-                    print("Response body:", new_R.read())
-                    print("Waiting a second and trying again...")
-                    time.sleep(1.0)
-
-        raise Exception("didn't succeed after retrying 10 times")
+        self._retry.call("uploading %s" % (filename,), attempt)
 
-    def _uploadArchive(self, archiveFile, path):
+    def _upload_multipart(self, filename, restarted=False):
+        # Upload filename with the S3 multipart API, several parts at a time.
+        # Acknowledged parts are recorded in MULTIPART_STATE_FILE, so after
+        # a failure - even in another process - only the parts the hub
+        # hasn't got yet are sent again.
         project = self._get_project_or_create(self._project_name)
         dotName = f"project-{project['id'][:8]}-default-workspace"
-        attempt = 0
-        while attempt < 10:
-            attempt += 1
-            with open(archiveFile, 'rb') as f:
-                # workaround https://github.com/psf/requests/issues/2422 - unable
-                # to see response code when body isn't fully consumed due to error
-                # (e.g. 423 Locked)
-                import http
-                from base64 import b64encode
-
-                userAndPass = b64encode((f"{self._auth[0]}:{self._auth[1]}").encode("ascii")).decode("ascii")
-                headers = {
-                    'Authorization' : 'Basic %s' %  userAndPass,
-                    'Extract' : 'true',
-                }
+        url = self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{filename}"
+        st = os.stat(filename)
+        part_size = self._multipart_part_size
+
+        state = self._load_multipart_state(url)
+        if state is None or state["size"] != st.st_size or state["mtime"] != st.st_mtime_ns or state["part_size"] != part_size:
+            state = {
+                "upload_id": self._initiate_multipart_upload(url),
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+                "part_size": part_size,
+                "parts": {},
+            }
+            self._save_multipart_state(url, state)
+
+        def upload_part(n):
+            etag = self._upload_part(url, filename, state["upload_id"], n, part_size)
+            with self._multipart_lock:
+                state["parts"][str(n)] = etag
+                self._save_multipart_state(url, state)
+
+        nparts = max(1, -(-st.st_size // part_size))
+        todo = [n for n in range(1, nparts + 1) if str(n) not in state["parts"]]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._upload_workers) as pool:
+                for _ in pool.map(upload_part, todo):
+                    pass
+            self._complete_multipart_upload(url, state)
+        except _MultipartUploadGone:
+            # The hub has forgotten the upload (e.g. it was aborted or
+            # expired), so the parts we recorded are no use
+            self._save_multipart_state(url, None)
+            if restarted:
+                raise Exception("Multipart upload of %s was lost by the hub twice" % (filename,))
+            print("Multipart upload of %s was lost by the hub, starting again" % (filename,))
+            return self._upload_multipart(filename, restarted=True)
+        self._save_multipart_state(url, None)
+
+    def _initiate_multipart_upload(self, url):
+        resp = self._hub_request("starting multipart upload to %s" % (url,), "POST", url, params={"uploads": ""})
+        return _xml_find(resp.content, "UploadId")
+
+    def _upload_part(self, url, filename, upload_id, n, part_size):
+        with open(filename, 'rb') as f:
+            f.seek((n - 1) * part_size)
+            data = f.read(part_size)
+        md5 = hashlib.md5(data)
+        # The hub checks the part against Content-MD5, and sends the MD5 back
+        # as the ETag, so corruption either way is caught and retried
+        headers = {"Content-MD5": base64.b64encode(md5.digest()).decode("ascii")}
+        what = "uploading part %d of %s" % (n, filename)
+        def attempt():
+            # Straight to the session: the retry policy below is the only
+            # one that should see each failure
+            resp = self._session.put(url, auth=self._auth, timeout=self._timeout, data=data, headers=headers,
+                                     params={"partNumber": n, "uploadId": upload_id})
+            if resp.status_code == 404:
+                raise _MultipartUploadGone()
+            if resp.status_code >= 300:
+                raise _HubError(what, resp.status_code, resp.content)
+            etag = resp.headers.get("ETag", "").strip('"')
+            if etag and etag != md5.hexdigest():
+                raise _HubError(what, resp.status_code, "checksum mismatch, ETag %s" % (etag,), retryable=True)
+            return etag or md5.hexdigest()
+        return self._retry.call(what, attempt)
+
+    def _complete_multipart_upload(self, url, state):
+        body = "<CompleteMultipartUpload>"
+        for n in sorted(state["parts"], key=int):
+            body += f'<Part><PartNumber>{n}</PartNumber><ETag>"{state["parts"][n]}"</ETag></Part>'
+        body += "</CompleteMultipartUpload>"
+        resp = self._hub_request("completing multipart upload to %s" % (url,), "POST", url, ok=(404,), data=body,
+                                 params={"uploadId": state["upload_id"]})
+        if resp.status_code == 404:
+            raise _MultipartUploadGone()
+
+    def _load_multipart_state(self, url):
+        try:
+            with open(os.path.join(self._root, MULTIPART_STATE_FILE)) as f:
+                return json.load(f).get(url)
+        except (OSError, ValueError):
+            return None
+
+    def _save_multipart_state(self, url, state):
+        # Pass state=None to forget about url
+        path = os.path.join(self._root, MULTIPART_STATE_FILE)
+        with self._multipart_lock:
+            try:
+                with open(path) as f:
+                    states = json.load(f)
+            except (OSError, ValueError):
+                states = {}
+            if state is None:
+                states.pop(url, None)
+            else:
+                states[url] = state
+            with open(path + ".tmp", "w") as f:
+                json.dump(states, f, sort_keys=True, indent=4)
+            os.replace(path + ".tmp", path)
+
+    def _upload_connection(self):
+        # Check out an idle keep-alive connection to the hub, or make a new
+        # one. Returns the connection and whether it was reused.
+        try:
+            return self._upload_connections.pop(), True
+        except IndexError:
+            pass
+        scheme, hostname = self._hostname.split("://")
+        if scheme == "http":
+            conn = http.client.HTTPConnection(hostname, timeout=self._timeout)
+        elif scheme == "https":
+            conn = http.client.HTTPSConnection(hostname, timeout=self._timeout)
+        else:
+            raise Exception("Unsupported scheme %s", scheme)
+        return conn, False
+
+    def _release_upload_connection(self, conn, reusable):
+        if reusable and len(self._upload_connections) < self._pool_size:
+            if conn.sock is not None:
+                conn.sock.settimeout(self._timeout)
+            self._upload_connections.append(conn)
+        else:
+            conn.close()
 
-                try:
-                    R = requests.put(self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{path}", f, headers=headers)                    
+    def _uploadConcurrently(self, files):
+        # Each file gets _upload's own retry and 423 handling; the first
+        # failure is raised once the files already in flight have finished.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._upload_workers) as pool:
+            for _ in pool.map(self._upload, files):
+                pass
 
-                    # Success, return - otherwise we'll retry
-                    return
-                except Exception as e:
-                    print("Error uploading %s: %s" % (archiveFile, e))
-                    new_R = conn.getresponse()
-                    print("Response code:", new_R.status)
-                    if new_R.status == 423:
-                        print("--> Try stopping Jupyter within Dotscience or wait "
-                             "for the lock owner (e.g. task ID) listed below to finish, then try again")
-                    print("Response body:", new_R.read())
-                    print("Waiting a second and trying again...")
-                    time.sleep(1.0)
-
-        raise Exception("didn't succeed after retrying 10 times")
-
-    def _commit_run_on_hub(self):
+    def _uploadArchive(self, archiveFile, path):
+        with open(archiveFile, 'rb') as f:
+            def body():
+                f.seek(0)
+                return f
+            self._putArchive(path, body)
+
+    def _uploadArchiveStream(self, files, path, sizes):
+        def body():
+            # A generator body makes requests use chunked transfer encoding;
+            # it can only be consumed once, so we build a new one per attempt.
+            sizes.clear()
+            return self._archive_stream(files, path, sizes)
+        self._putArchive(path, body)
+
+    def _archive_stream(self, files, path, sizes):
+        # The tar of files as a stream of chunks, compressed if we've been
+        # asked to, in which case sizes gets the before and after sizes
+        dirPrefix = path + "/"
+        tar = _tar_stream(files, lambda f: remove_prefix(f, dirPrefix))
+        if not self._compression:
+            return tar
+        return _compress_stream(tar, self._compression, self._compression_level, self._upload_bandwidth, sizes)
+
+    def _putArchive(self, path, body):
+        project = self._get_project_or_create(self._project_name)
+        dotName = f"project-{project['id'][:8]}-default-workspace"
+        headers = {'Extract' : 'true'}
+        if self._compression:
+            headers['Content-Encoding'] = self._compression
+        # The hub only answers once it has unpacked the whole archive, so
+        # timeout only covers connecting and sending it
+        self._hub_request("uploading %s" % (path,), "PUT", self._hostname+f"/v2/dotmesh/s3/{self._auth[0]}:{dotName}/{path}",
+                          body=body, headers=headers, timeout=(self._timeout, self._upload_timeout))
+
+    def _commit_run_on_hub(self, run):
+        return self._commit_runs_on_hub([run])[0]
+
+    def _commit_runs_on_hub(self, runs):
         """
         Set up commit metadata a bit like this:
 
@@ -620,201 +2104,276 @@ class Dotscience:
 
         commit = {}
         commit["author"] = self._auth[0]
-        commit["exec.start"] = self.currentRun._start.strftime("%Y%m%dT%H%M%S.%f")
-        commit["exec.end"] = self.currentRun._end.strftime("%Y%m%dT%H%M%S.%f")
+        commit["exec.start"] = min(run._start for run in runs).strftime("%Y%m%dT%H%M%S.%f")
+        commit["exec.end"] = max(run._end for run in runs).strftime("%Y%m%dT%H%M%S.%f")
         commit["exec.logs"] = json.dumps([])
         commit["runner.name"] = platform.node()
         commit["runner.platform"] = platform.system()
         commit["runner.platform_version"] = platform.version()
         # newID was called just before _publish_remote_run so this should be safe...
-        commit["runs"] = json.dumps([self.currentRun._id])
+        commit["runs"] = json.dumps([run._id for run in runs])
         commit["workload.type"] = "remote"
         commit["type"] = "dotscience.run.v1"
 
-        # TODO: insert run classes here
-        run = self.currentRun.metadata()
+        for run in runs:
+            # TODO: insert run classes here
+            for k, v in flatten(run.metadata()):
+                commit[f"run.{run._id}.{k}"] = v
 
-        for k, v in flatten(run):
-            commit[f"run.{self.currentRun._id}.{k}"] = v
-
-        commit[f"run.{self.currentRun._id}.authority"] = "remote"
-        # TODO the following might not work well from jupyter
-        commit[f"run.{self.currentRun._id}.workload-file"] = sys.argv[0]
-        # TODO add timestamp?
+            commit[f"run.{run._id}.authority"] = "remote"
+            # TODO the following might not work well from jupyter
+            commit[f"run.{run._id}.workload-file"] = run._workload_file or sys.argv[0]
+            # TODO add timestamp?
 
         project = self._get_project_or_create(self._project_name)
         dotName = f"project-{project['id'][:8]}-default-workspace"
-        dot = self._dotmesh_client.getDot(dotname=dotName, ns=self._auth[0])
-        branch = dot.getBranch("master")
-        result = branch.commit("Remote dotscience run", commit)
-        # construct URL
-        runURL = f"{self._hostname}/project/{project['id']}/runs/metric/{self.currentRun._id}"
-        return runURL
-
-    def _find_model_id(self, run_id):
-        attempt = 0
-        while attempt < 10:
-            attempt += 1
-            # TODO: replace with a query arg in the backend to avoid iterating
-            models = requests.get(self._hostname+"/v2/models", auth=self._auth).json()
-            model_id = None
-            for model in models:
-                if model["run_id"] == self.currentRun._id:
-                    # found it!
-                    model_id = model["id"]
-                    return model_id
-            if model_id is None:
-                print("Unable to find model with run id %r yet... (models=%s)" % (self.currentRun._id, models))
-                print("Trying again in 1 second")
-                time.sleep(1.0)
-
-        raise Exception("Unable to find model with run id %s after 10 tries" % (run_id,))
-
-    def _initiate_build(self, model_id):
-        attempt = 0
-        the_exc = None
-        while attempt < 120:
-            attempt += 1
-            try:               
-                resp = requests.post(self._hostname+f"/v2/models/{model_id}/builds", auth=self._auth, json={"builder": os.getenv(ENV_DOTSCIENCE_BUILDER, default='')})
-                if resp.status_code != 201:
-                    raise Exception(f"Error {resp.status_code} on POST to /v2/models/{model_id}/builds: {resp.content}")
-                build = resp.json()
-                return build
+        branch = self._master_branch(dotName)
+        # Committing twice would record the runs twice, so only try again
+        # if the commit can't have reached the hub
+        self._dotmesh_call(
+            "committing runs", lambda: branch.commit("Remote dotscience run" if len(runs) == 1 else "Remote dotscience runs", commit),
+            retryable=lambda e: isinstance(e, requests.ConnectionError))
+        # construct URLs
+        return [f"{self._hostname}/project/{project['id']}/runs/metric/{run._id}" for run in runs]
+
+    def _find_model_id(self, run_id, deadline):
+        index = _model_index(self._hostname, self._auth[0])
+        return self._wait_for("find model with run id %s" % (run_id,), lambda: index.find(self, run_id), deadline)
+
+    def _initiate_build(self, model_id, deadline):
+        def check():
+            return self._hub_request("starting build of model %s" % (model_id,), "POST", self._hostname+f"/v2/models/{model_id}/builds",
+                                     attempts=1, json={"builder": os.getenv(ENV_DOTSCIENCE_BUILDER, default='')}).json()
+        return self._wait_for("start building model", check, deadline)
+
+    def _build_docker_image_on_hub(self, run):
+        # If we've already had an image built from the same model, use that
+        fingerprint = None
+        if self._build_cache:
+            # With dedupe, the upload has just hashed any files that changed
+            hashes = dict(self._file_hashes)
+            if self._dedupe:
+                hashes.update(self._load_upload_manifest())
+            fingerprint = _model_fingerprint(run, hashes)
+            self._file_hashes.update(hashes)
+        if fingerprint is not None:
+            try:
+                image = self._cached_build(fingerprint)
             except Exception as e:
-                the_exc = e
-                print(".", end="")
-                sys.stdout.flush()
-                time.sleep(1.0)
-            if attempt == 60:
-                print("\nSeems to be taking a long time, waiting one more minute")
-
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-        print("Failed to start building model within 2 minutes, please let us know using the Intercom button bottom right, or email support@dotscience.com so that we can fix it with your help - thanks!\n")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        if the_exc != None:
-            raise the_exc
-        else:
-            raise Exception("Unable to load error")
+                # Not being able to check is no reason not to build it
+                print(" unable to look up the image built from the same model (%s), building it..." % (e,), end="")
+                image = None
+            if image is not None:
+                print(" reusing the image built from the same model...", end="")
+                return image
+
+        # Finding the model, starting the build and the build itself all
+        # have to fit in build_timeout
+        deadline = time.time() + self._build_timeout
+        model_id = self._find_model_id(run._id, deadline)
+        build = self._initiate_build(model_id, deadline)
+        image = build["image_name"]
+        build_id = build["id"]
+        path = f"/v2/models/{model_id}/builds/{build_id}"
+        def check():
+            for status in self._watch_status(path, deadline):
+                if status["status"] in ("completed", "failed"):
+                    return status
+        build = self._wait_for("build model", check, deadline)
+        if build["status"] == "failed":
+            raise Exception("Build failed: %s" % (build,))
+        if fingerprint is not None:
+            self._save_cached_build(fingerprint, {"image": image, "model_id": model_id, "build_id": build_id, "time": time.time()})
+        return image
+
+    def _watch_status(self, path, deadline):
+        # Yield the status of the thing at path on the hub. If status_subscribe
+        # is set, ask for a stream of server-sent events and yield each one as
+        # it arrives; hubs that don't support that just send the status, and
+        # then we poll.
+        headers = {}
+        if self._status_subscribe:
+            headers["Accept"] = "text/event-stream, application/json"
+        resp = self._hub_request("getting %s" % (path,), "GET", self._hostname+path, attempts=1, headers=headers,
+                                 stream=self._status_subscribe)
+        with resp:
+            if not resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+                yield resp.json()
+                return
+            data = []
+            for line in resp.iter_lines(decode_unicode=True):
+                if line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif not line and data:
+                    yield json.loads("\n".join(data))
+                    data = []
+                if time.time() >= deadline:
+                    return
+            if data:
+                yield json.loads("\n".join(data))
 
+    def _wait_for(self, what, check, deadline):
+        """Call check() until it returns something other than None, and
+        return that. Errors from check() are retried as well.
 
-    def _build_docker_image_on_hub(self):
-        # find model id
-        model_id = self._find_model_id(self.currentRun._id)
-        build = self._initiate_build(model_id)
-        self._docker_image = build["image_name"]
-        attempt = 0
+        Between tries, wait with exponential backoff and jitter, starting at
+        POLL_MIN_INTERVAL and going up to poll_max_interval, so that quick
+        things are noticed quickly and slow ones don't get hammered. Once
+        it's past deadline (a time.time()), give up and raise the last error.
+        """
+        started = time.time()
+        interval = POLL_MIN_INTERVAL
+        warned = False
         the_exc = None
-        while attempt < 120:
-            attempt += 1
+        while True:
             try:
-                resp = requests.get(self._hostname+f"/v2/models/{model_id}/builds/{build['id']}", auth=self._auth)
-                if resp.status_code != 200:
-                    raise Exception(f"Error {resp.status_code} on GET to /v2/models/{model_id}/builds/{build['id']}: {resp.content}")
-                build = resp.json()
-                if build["status"] != "completed":
-                    raise Exception(f"build not complete: {build}")
-                return self._docker_image
+                result = check()
+                if result is not None:
+                    return result
+                the_exc = None
+            except HubUnavailable:
+                raise
             except Exception as e:
                 the_exc = e
-                print(".", end="")
-                sys.stdout.flush()
-                time.sleep(1.0)
-            if build is not None and build["status"] == "failed":
-                raise Exception("Build failed: %s", build)
-            if attempt == 60:
-                print("\nSeems to be taking a long time, waiting one more minute")
+            now = time.time()
+            if now >= deadline:
+                break
+            if not warned and now - started > (deadline - started) / 2:
+                warned = True
+                print("\nSeems to be taking a long time, waiting up to %d more seconds" % (deadline - now,))
+            print(".", end="")
+            sys.stdout.flush()
+            time.sleep(min(random.uniform(interval / 2, interval), deadline - now))
+            interval = min(interval * 2, self._poll_max_interval)
 
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-        print("Failed to build model within 2 minutes, please let us know using the Intercom button bottom right, or email support@dotscience.com so that we can fix it with your help - thanks!\n")
+        print("Failed to %s within %d seconds, please let us know using the Intercom button bottom right, or email support@dotscience.com so that we can fix it with your help - thanks!\n" % (what, deadline - started))
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         if the_exc != None:
             raise the_exc
         else:
-            raise Exception("Unable to load error")
-
-        return self._docker_image
+            raise TimeoutError("Timed out trying to %s" % (what,))
 
     def _get_deployment_url(self, host):
         scheme = os.getenv('DOTSCIENCE_MODEL_URL_SCHEME', default="https")
         return scheme+"://"+host+"/v1/models/model"
 
-    def _deploy_to_kube(self):
+    def _find_deployer(self):
+        # Returns the deployer to deploy to, and our deployment on it if
+        # there is one already.
         # TODO: support specifying the deployer
-        deployers = requests.get(self._hostname+"/v2/deployers", auth=self._auth).json()
+        deployers = self._hub_request("listing deployers", "GET", self._hostname+"/v2/deployers").json()
         online = [d for d in deployers if d["status"] == "online"]
         if len(online) == 0:
             raise Exception("Can't deploy - no online deployers found")
-        deployer = online[0]
-        self._deployer = deployer
+        # Keep updating the deployer that already has our deployment
+        for deployer in online:
+            existing = self._find_deployment(deployer, self._deployment_name())
+            if existing is not None:
+                return deployer, existing
+        return _pick_deployer(online, self._deployer_turn()), None
+
+    def _deployer_turn(self):
+        # Whose turn it is to get a new deployment, if deployers don't say
+        # how loaded they are. Kept in the user's cache, as most processes
+        # only deploy once, and only moved on by _deploy_to_kube once a
+        # deployment has been created, so failed deploys don't skip a turn.
+        return _read_user_cache(DEPLOYER_TURNS_FILE).get("%s %s" % (self._hostname, self._auth[0]), 0)
+
+    def _next_deployer_turn(self):
+        key = "%s %s" % (self._hostname, self._auth[0])
+        def update(turns):
+            turns[key] = turns.get(key, 0) + 1
+            return True
+        _update_user_cache(DEPLOYER_TURNS_FILE, update)
+
+    def _deployment_name(self):
+        return self._project_name.replace('-', '')
+
+    def _deploy_to_kube(self, run, image, deployer=None, existing=None):
+        # existing is the deployment _find_deployer found on deployer
+        if deployer is None:
+            deployer, existing = self._find_deployer()
         body = {
             # TODO fill this in
-            "name": self._project_name.replace('-', ''),
+            "name": self._deployment_name(),
             "namespace": "default",
-            "image_name": self._docker_image,
+            "image_name": image,
             "container_port": 8501,
-            "model_name": self._project_name.replace('-', ''), # XXX should this be the same as name?
-            "replicas": 1
+            "model_name": self._deployment_name(), # XXX should this be the same as name?
+            "replicas": self._replicas,
         }
+        if self._resource_requests:
+            body["resources"] = {"requests": self._resource_requests}
+        if self._autoscaling is not None:
+            body["autoscaling"] = self._autoscaling
         try:
             classes_file = json.loads(
-                list(self.currentRun.metadata()["labels"].values())[0],
+                list(run.metadata()["labels"].values())[0],
             )["files"]["classes"]
             # XXX what if it's changed in between model() and this point in publish()?
-            import base64
             classes_data = open(classes_file, 'rb').read()
             classes_encoded = base64.b64encode(classes_data)
             body["model_classes"] = classes_encoded.decode('ascii')
         except Exception as e:
             print("Unable to extract classes file (error = %s), continuing regardless (try passing classes=\"classes.json\" to ds.model, where classes.json contains a single map from class ids (strings) to human readable classnames..." % (e,))
-        deployment = requests.post(
+        if existing is not None:
+            # Roll the new image out to the deployment we already have, which
+            # keeps serving the old one until the new one is up, rather than
+            # provisioning a new deployment from scratch
+            deployment = self._hub_request(
+                "updating deployment %s" % (existing["id"],), "PUT",
+                self._hostname+f"/v2/deployers/{deployer['id']}/deployments/{existing['id']}",
+                attempts=1,
+                json=body,
+            )
+            return deployer, deployment.json(), True
+        deployment = self._hub_request(
+            "creating deployment", "POST",
             self._hostname+f"/v2/deployers/{deployer['id']}/deployments",
+            attempts=1,
             json=body,
-            auth=self._auth,
         )
-        self._deployment = deployment.json()
-        return self._get_deployment_url(deployment.json()["host"]) + ":predict"
+        self._next_deployer_turn()
+        return deployer, deployment.json(), False
+
+    def _find_deployment(self, deployer, name):
+        # Hubs that can't list deployments get a new one each time
+        resp = self._hub_request("listing deployments", "GET",
+                                 self._hostname+f"/v2/deployers/{deployer['id']}/deployments", ok=(404,))
+        if resp.status_code == 404:
+            return None
+        for deployment in resp.json() or []:
+            if deployment.get("name") == name:
+                return deployment
+        return None
 
-    def _wait_active(self):
-        if self._deployment is None:
-            raise Exception("tried to wait for model to become active when no self._deployment was set")
-        attempt = 0
-        the_exc = None
-        while attempt < 120:
-            attempt += 1
-            try:
-                resp = requests.get(self._get_deployment_url(self._deployment["host"]))
-                if resp.status_code != 200:
-                    raise Exception("status code %s" % (resp.status_code,))
-                return
-            except Exception as e:
-                the_exc = e
-                print(".", end="")
-                sys.stdout.flush()
-                time.sleep(1.0)
-            if attempt == 60:
-                print("\nSeems to be taking a long time, waiting one more minute")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-        print("Failed to contact model within 2 minutes, please let us know using the Intercom button bottom right, or email support@dotscience.com so that we can fix it with your help - thanks!\n")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        if the_exc != None:
-            raise the_exc
-        else:
-            raise Exception("Unable to load error")
-
-    def _setup_grafana(self):
-        if self._deployment is None:
-            raise Exception("tried to set up dashboard when no self._deployment was set")
-        if self._deployer is None:
-            raise Exception("tried to set up dashboard when no self._deployer was set")
-        deployer_id = self._deployer["id"]
-        deployment_id = self._deployment["id"]
-        grafana = requests.post(
+    def _wait_active(self, deployment):
+        def check():
+            resp = self._session.get(self._get_deployment_url(deployment["host"]), timeout=self._timeout)
+            if resp.status_code != 200:
+                raise Exception("status code %s" % (resp.status_code,))
+            return True
+        self._wait_for("contact model", check, time.time() + self._deploy_timeout)
+
+    def _setup_grafana(self, deployer, deployment, existing=False):
+        deployer_id = deployer["id"]
+        deployment_id = deployment["id"]
+        if existing:
+            # Deployments we've updated keep the dashboard they already have
+            grafana = self._hub_request(
+                "getting dashboard", "GET",
+                self._hostname+f"/v2/deployers/{deployer_id}/deployments/{deployment_id}/dashboard",
+                ok=(404,),
+            )
+            if grafana.status_code != 404:
+                return grafana.json()['dashboardURL']
+        grafana = self._hub_request(
+            "creating dashboard", "POST",
             self._hostname+f"/v2/deployers/{deployer_id}/deployments/{deployment_id}/dashboard",
+            attempts=1,
             json={},
-            auth=self._auth,
         )
-        # TODO check status code
         dashboard = grafana.json()
         return dashboard['dashboardURL']
 
@@ -857,17 +2416,17 @@ class Dotscience:
         self._check_started()
         return self.currentRun.input(filename)
 
-    def add_output(self, filename):
+    def add_output(self, filename, **kwargs):
         self._check_started()
-        self.currentRun.add_output(filename)
+        self.currentRun.add_output(filename, **kwargs)
 
-    def add_outputs(self, *args):
+    def add_outputs(self, *args, **kwargs):
         self._check_started()
-        self.currentRun.add_outputs(*args)
+        self.currentRun.add_outputs(*args, **kwargs)
 
-    def output(self, filename):
+    def output(self, filename, **kwargs):
         self._check_started()
-        return self.currentRun.output(filename)
+        return self.currentRun.output(filename, **kwargs)
 
     def add_label(self, label, value):
         self._check_started()
@@ -932,8 +2491,8 @@ def script(workload_file = None):
 def remote():
     _defaultDS.remote()
 
-def publish(description=None, stream=sys.stdout, build=False, deploy=False):
-    _defaultDS.publish(description, stream, build, deploy)
+def publish(description=None, stream=sys.stdout, build=False, deploy=False, **kwargs):
+    return _defaultDS.publish(description, stream, build, deploy, **kwargs)
 
 def start(description = None):
     _defaultDS.start(description)
@@ -962,14 +2521,14 @@ def add_inputs(*filenames):
 def input(filename):
     return _defaultDS.input(filename)
 
-def add_output(filename):
-    _defaultDS.add_output(filename)
+def add_output(filename, **kwargs):
+    _defaultDS.add_output(filename, **kwargs)
 
-def add_outputs(*filenames):
-    _defaultDS.add_outputs(*filenames)
+def add_outputs(*filenames, **kwargs):
+    _defaultDS.add_outputs(*filenames, **kwargs)
 
-def output(filename):
-    return _defaultDS.output(filename)
+def output(filename, **kwargs):
+    return _defaultDS.output(filename, **kwargs)
 
 def add_label(label, value):
     _defaultDS.add_label(label, value)
@@ -1004,6 +2563,410 @@ def parameter(label, value):
 def remove_prefix(text, prefix):
     return text[text.startswith(prefix) and len(prefix):]
 
+class _OutputWatcher:
+    # Uploads the current run's output files in the background as soon as
+    # they stop changing, so that publish() only has to wait for whatever
+    # is still in flight. A file counts as finished once its size and mtime
+    # are the same on two polls in a row.
+
+    def __init__(self, ds, interval):
+        self._ds = ds
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._seen = {}      # file -> (size, mtime) at the last poll
+        self._uploaded = {}  # file -> (size, mtime) when it was uploaded
+        self._inflight = {}  # file -> ((size, mtime), future)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=ds._upload_workers)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print("Error watching output files: %s" % (e,))
+
+    def poll(self):
+        run = self._ds.currentRun
+        if run is None:
+            return
+        files = set()
+        for o in list(run._outputs):
+            files |= run._expand_output(o)
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            key = (st.st_size, st.st_mtime_ns)
+            previous, self._seen[f] = self._seen.get(f), key
+            if key != previous:
+                # New, or still being written
+                continue
+            with self._lock:
+                if self._uploaded.get(f) == key or (f in self._inflight and self._inflight[f][0] == key):
+                    continue
+                self._inflight[f] = (key, self._pool.submit(self._upload, f, key))
+
+    def _upload(self, f, key):
+        try:
+            self._ds._upload(f)
+            ok = True
+        except Exception as e:
+            # It'll be uploaded by publish() instead
+            print("Error uploading %s in the background: %s" % (f, e))
+            ok = False
+        with self._lock:
+            if ok:
+                self._uploaded[f] = key
+            if self._inflight.get(f, (None,))[0] == key:
+                del self._inflight[f]
+
+    def wait_uploaded(self, files):
+        # Wait for the uploads in flight, then return those of files that
+        # have been uploaded and not changed since
+        with self._lock:
+            futures = [future for (key, future) in self._inflight.values()]
+        concurrent.futures.wait(futures)
+        done = set()
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            if self._uploaded.get(f) == (st.st_size, st.st_mtime_ns):
+                done.add(f)
+        return done
+
+    def stop(self):
+        self._stopped.set()
+        self._pool.shutdown(wait=False)
+
+def _run_stages(stages):
+    """Run stages, a dict of name -> (names of the stages it needs, fn),
+    starting each one as soon as the stages it needs have finished. fn is
+    called with a dict of the results of the stages finished so far.
+
+    Returns the results of all the stages, and how long each took in
+    seconds. If a stage fails, the stages that need it (directly or not)
+    aren't started, but the others still run, e.g. a run is still
+    committed if looking for a deployer fails. The first error is raised
+    once they've finished.
+    """
+    results = {}
+    timings = {}
+    def timed(name, fn, finished):
+        start = time.time()
+        try:
+            return fn(finished)
+        finally:
+            timings[name] = time.time() - start
+
+    pending = dict(stages)
+    running = {}
+    failed = set()
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+        while True:
+            skipped = True
+            while skipped:
+                skipped = [name for name, (needs, fn) in pending.items() if failed.intersection(needs)]
+                for name in skipped:
+                    del pending[name]
+                    failed.add(name)
+            for name, (needs, fn) in list(pending.items()):
+                if all(n in results for n in needs):
+                    del pending[name]
+                    running[pool.submit(timed, name, fn, dict(results))] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                try:
+                    results[name] = f.result()
+                except Exception as e:
+                    failed.add(name)
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    if pending:
+        raise RuntimeError("Publish stages %s need stages that don't exist" % (sorted(pending),))
+    return results, timings
+
+def _block_signature(filename, block_size):
+    st = os.stat(filename)
+    blocks = []
+    with open(filename, 'rb') as f:
+        for buf in iter(lambda: f.read(block_size), b""):
+            blocks.append(hashlib.sha256(buf).hexdigest())
+    return {"size": st.st_size, "mtime": st.st_mtime_ns, "block_size": block_size, "blocks": blocks}
+
+def _signature_digest(signature):
+    # Identifies the file a signature describes, without hashing it again
+    h = hashlib.sha256(b"%d:%d:" % (signature["size"], signature["block_size"]))
+    for block in signature["blocks"]:
+        h.update(block.encode("ascii"))
+    return h.hexdigest()
+
+def _put_file_zero_copy(conn, url, f, headers):
+    # Send a PUT of the file f over a plain HTTP connection, handing the body
+    # to the kernel with sendfile() rather than copying it through Python
+    # buffers like HTTPConnection.request does. Where there's no sendfile,
+    # the file is mmapped, so at least it's sent without being read into
+    # Python objects first.
+    size = os.fstat(f.fileno()).st_size
+    conn.putrequest("PUT", url, skip_accept_encoding=True)
+    for k, v in headers.items():
+        conn.putheader(k, v)
+    conn.putheader("Content-Length", str(size))
+    conn.endheaders()
+    if size == 0:
+        return
+    if hasattr(os, "sendfile"):
+        conn.sock.sendfile(f)
+    else:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            conn.sock.sendall(memoryview(m))
+
+def _hub_unreachable(e):
+    # Whether e (or what caused it) means we couldn't get through to the hub,
+    # rather than the hub turning us down
+    while e is not None:
+        if isinstance(e, (HubUnavailable, requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+            return True
+        if isinstance(e, _HubError) and e.retryable:
+            return True
+        e = e.__cause__
+    return False
+
+def _save_spool_entry(path, entry):
+    with open(path + ".tmp", "w") as f:
+        json.dump(entry, f, sort_keys=True, indent=4)
+    os.replace(path + ".tmp", path)
+
+def _user_cache_path(filename):
+    cache = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, filename)
+
+def _read_user_cache(filename):
+    try:
+        with open(_user_cache_path(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _update_user_cache(filename, update):
+    # Apply update to the entries in one of the JSON files in the user's
+    # cache directory, and save them unless it returns False
+    path = _user_cache_path(filename)
+    entries = _read_user_cache(filename)
+    if not update(entries):
+        return
+    # Other processes may be doing the same, so each writes its own temp
+    # file before moving it into place
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(entries, f, sort_keys=True, indent=4)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("Unable to save cache %s: %s" % (path, e))
+
+def _print_hub_error(what, status, body):
+    print("Error %s" % (what,))
+    print("Response code:", status)
+    if status == 423:
+        print("--> Try stopping Jupyter within Dotscience or wait "
+             "for the lock owner (e.g. task ID) listed below to finish, then try again")
+    print("Response body:", body)
+
+def _xml_find(content, tag):
+    # S3 responses are namespaced, so match on the local part of the tag
+    for el in xml.etree.ElementTree.fromstring(content).iter():
+        if el.tag.split("}")[-1] == tag:
+            return el.text
+    raise Exception("No %s in response %r" % (tag, content))
+
+def _sha256_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for buf in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def _pick_deployer(deployers, turn):
+    # The least loaded of deployers, going by the load (the fraction of its
+    # capacity in use) they report, or failing that the one with the most
+    # spare capacity. Deployers that don't report either only get picked if
+    # none do, in turn.
+    loaded = [d for d in deployers if d.get("load") is not None]
+    if loaded:
+        return min(loaded, key=lambda d: float(d["load"]))
+    spare = [d for d in deployers if d.get("capacity") is not None]
+    if spare:
+        return max(spare, key=lambda d: float(d["capacity"]))
+    deployers = sorted(deployers, key=lambda d: d["id"])
+    return deployers[turn % len(deployers)]
+
+def _model_fingerprint(run, hashes=None):
+    # A digest of everything an image is built from: the model's files that
+    # are published with the run, its type and framework version, and the
+    # builder. None if the run doesn't record a model (see Run.model) or its
+    # files have gone, as then we can't tell what the image would be built
+    # from. hashes maps output files to their _manifest_entry, and is
+    # brought up to date; files whose size and mtime match aren't reread.
+    if hashes is None:
+        hashes = {}
+    artefacts = {}
+    try:
+        outputs = run.metadata()["output"]
+        for label, value in run._labels.items():
+            if not label.startswith("artefact:"):
+                continue
+            artefact = json.loads(value)
+            files = {k: _files_digest(run._root, outputs, f, hashes) for k, f in artefact.get("files", {}).items()}
+            if None in files.values():
+                return None
+            artefacts[label[len("artefact:"):]] = {
+                "type": artefact.get("type"),
+                "version": artefact.get("version"),
+                "files": files,
+            }
+    except OSError:
+        return None
+    if not artefacts:
+        return None
+    fingerprint = {"builder": os.getenv(ENV_DOTSCIENCE_BUILDER, default=''), "artefacts": artefacts}
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _files_digest(root, outputs, path, hashes):
+    # sha256 of the names and contents of the output files at or under path,
+    # or None if there aren't any
+    path = os.path.normpath(path)
+    files = sorted(f for f in outputs if f == path or f.startswith(path + os.sep))
+    if not files:
+        return None
+    h = hashlib.sha256()
+    for f in files:
+        hashes[f] = _manifest_entry(os.path.join(root, f), hashes.get(f))
+        h.update(json.dumps([os.path.relpath(f, path), hashes[f]["sha256"]]).encode("utf-8") + b"\n")
+    return h.hexdigest()
+
+def _manifest_entry(filename, previous=None):
+    # Describe filename for the upload manifest. Hashing is skipped when the
+    # size and mtime match the previous entry, as rehashing a multi-GB model
+    # on every publish would cost more than the upload we're trying to save.
+    st = os.stat(filename)
+    entry = {"size": st.st_size, "mtime": st.st_mtime_ns}
+    if previous and previous.get("size") == entry["size"] and previous.get("mtime") == entry["mtime"]:
+        entry["sha256"] = previous["sha256"]
+    else:
+        entry["sha256"] = _sha256_file(filename)
+    return entry
+
+def _balanced_shards(files, n):
+    # Split files into at most n lists of roughly equal total size, by
+    # handing out the biggest files first, each to the smallest shard so far
+    shards = [[] for _ in range(n)]
+    sizes = [0] * n
+    for f in sorted(files, key=os.path.getsize, reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append(f)
+        sizes[i] += os.path.getsize(f)
+    return [sorted(shard) for shard in shards if shard]
+
+def _compress_block(codec, level, block):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(block)
+    # A complete gzip member; zlib releases the GIL while it works, so
+    # blocks really are compressed in parallel
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(block) + c.flush()
+
+def _pick_compression_level(codec, sample, workers, bandwidth):
+    # Try each level on sample, and pick the one we expect to get the data
+    # to the hub soonest: compression on all cores runs alongside the
+    # upload, so whichever of the two is slower sets the pace.
+    best = None
+    for level in COMPRESSION_LEVELS[codec]:
+        t0 = time.perf_counter()
+        compressed = _compress_block(codec, level, sample)
+        elapsed = time.perf_counter() - t0
+        estimate = max(elapsed / workers, len(compressed) / bandwidth)
+        if best is None or estimate < best[0]:
+            best = (estimate, level)
+    return best[1]
+
+def _rechunk(chunks, size):
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+def _compress_stream(chunks, codec, level, bandwidth, sizes):
+    # Compress a stream of chunks in COMPRESSION_BLOCK_SIZE blocks on every
+    # core, yielding the results in order. Only a couple of blocks per core
+    # are in flight at once, so memory use stays bounded.
+    workers = os.cpu_count() or 1
+    sizes["raw_bytes"] = sizes["compressed_bytes"] = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for block in _rechunk(chunks, COMPRESSION_BLOCK_SIZE):
+            if level is None:
+                level = _pick_compression_level(codec, block, workers, bandwidth)
+            sizes["raw_bytes"] += len(block)
+            pending.append(pool.submit(_compress_block, codec, level, block))
+            if len(pending) >= workers * 2:
+                compressed = pending.popleft().result()
+                sizes["compressed_bytes"] += len(compressed)
+                yield compressed
+        while pending:
+            compressed = pending.popleft().result()
+            sizes["compressed_bytes"] += len(compressed)
+            yield compressed
+
+def _tar_stream(files, arcname, chunk_size=UPLOAD_CHUNK_SIZE):
+    # Yield an uncompressed tar archive of files piece by piece. The headers
+    # are built with tarfile, but file bodies are read in chunk_size pieces
+    # rather than handed to TarFile.add, which would buffer a whole member.
+    written = 0
+    for f in files:
+        st = os.stat(f)
+        info = tarfile.TarInfo(arcname(f))
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = st.st_mode & 0o7777
+        header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+        written += len(header)
+        yield header
+        remaining = info.size
+        with open(f, 'rb') as fh:
+            while remaining > 0:
+                buf = fh.read(min(chunk_size, remaining))
+                if not buf:
+                    raise Exception("%s got shorter while it was being uploaded" % (f,))
+                remaining -= len(buf)
+                written += len(buf)
+                yield buf
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            written += padding
+            yield tarfile.NUL * padding
+    # Two empty blocks mark the end of the archive, then pad out the record
+    # like TarFile.close() does
+    trailer = tarfile.BLOCKSIZE * 2
+    trailer += -(written + trailer) % tarfile.RECORDSIZE
+    yield tarfile.NUL * trailer
+
 add_metric = add_metric
 add_metrics = add_metrics
 metric = metric
@@ -1012,14 +2975,27 @@ param = parameter
 def debug():
     _defaultDS.debug()
 
-def connect(username, apikey, project, hostname=""):
+def flush_spool():
+    return _defaultDS.flush_spool()
+
+def connect(username, apikey, project, hostname="", **kwargs):
     # Allow defaulting on empty string e.g. from env
     if not hostname:
         hostname = "https://cloud.dotscience.com"
     _defaultDS.connect(
-        username, apikey, project, hostname,
+        username, apikey, project, hostname, **kwargs
+    )
+
+async def aconnect(username, apikey, project, hostname="", **kwargs):
+    if not hostname:
+        hostname = "https://cloud.dotscience.com"
+    await _defaultDS.aconnect(
+        username, apikey, project, hostname, **kwargs
     )
 
+async def apublish(description=None, stream=sys.stdout, build=False, deploy=False, **kwargs):
+    return await _defaultDS.apublish(description, stream, build, deploy, **kwargs)
+
 # Backwards compatibility:
 summary = metric
 add_summary = add_metric
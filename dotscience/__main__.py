@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+
+import dotscience
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="dotscience", description="Tools for Dotscience workloads")
+    commands = parser.add_subparsers(dest="command")
+
+    flush = commands.add_parser("flush-spool", help="publish runs saved while the Dotscience Hub was unreachable")
+    flush.add_argument("--username", default=os.getenv("DOTSCIENCE_USERNAME"))
+    flush.add_argument("--apikey", default=os.getenv("DOTSCIENCE_APIKEY"))
+    flush.add_argument("--project", default=os.getenv("DOTSCIENCE_PROJECT_NAME"))
+    flush.add_argument("--hostname", default=os.getenv("DOTSCIENCE_HOSTNAME", ""))
+    flush.add_argument("--root", default=".", help="the workspace the runs were published from")
+
+    daemon = commands.add_parser("publisher", help="publish runs for the training processes on this machine")
+    daemon.add_argument("--socket", default=os.getenv("DOTSCIENCE_PUBLISHER_SOCKET"),
+                        help="the Unix socket to listen on, which processes find in $DOTSCIENCE_PUBLISHER_SOCKET")
+    daemon.add_argument("--root", default=".", help="the workspace the processes run in")
+    daemon.add_argument("--batch-window", type=float, default=dotscience.PUBLISHER_BATCH_WINDOW,
+                        help="how long to wait for more runs before committing (seconds)")
+    daemon.add_argument("--upload-workers", type=int, default=4)
+
+    args = parser.parse_args(argv)
+    if args.command == "publisher":
+        return publisher(parser, args)
+    if args.command != "flush-spool":
+        parser.print_help()
+        return 2
+    if not (args.username and args.apikey and args.project):
+        parser.error("--username, --apikey and --project (or $DOTSCIENCE_USERNAME, $DOTSCIENCE_APIKEY and $DOTSCIENCE_PROJECT_NAME) are needed")
+
+    # Output files were recorded relative to the workspace
+    os.chdir(args.root)
+    dotscience.connect(args.username, args.apikey, args.project, args.hostname)
+    published = dotscience.flush_spool()
+    print("Published %d runs" % (len(published),))
+    return 0
+
+
+def publisher(parser, args):
+    if not args.socket:
+        parser.error("--socket (or $DOTSCIENCE_PUBLISHER_SOCKET) is needed")
+    socket = os.path.abspath(args.socket)
+    # Output files were recorded relative to the workspace
+    os.chdir(args.root)
+    daemon = dotscience.PublisherDaemon(socket, ".", batch_window=args.batch_window,
+                                        upload_workers=args.upload_workers)
+    print("Publishing runs handed to %s" % (socket,))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
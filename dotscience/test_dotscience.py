@@ -1,5 +1,6 @@
 import dotscience
 
+import hashlib
 import json
 import datetime
 import re
@@ -7,10 +8,18 @@ import io
 import os
 import sys
 import shutil
+import time
+import asyncio
+import pytest
 
 from hypothesis import given, assume, note
 from hypothesis.strategies import text, lists, sampled_from
 
+@pytest.fixture(autouse=True)
+def user_cache(monkeypatch, tmp_path):
+    """Keeps what the library caches for the user out of their real
+    cache directory."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
 
 def test_metric_to_summary_backwards_compatibility():
     """summary()/add_summary()/add_summaries() backwards compatibility."""
@@ -939,3 +948,1554 @@ def test_reconnect_resets_internal_state(monkeypatch):
     }
     assert ds._project_name == "myproj2"
     assert ds._cached_project == None
+
+###
+### Test remote mode against a fake hub
+###
+
+import tarfile
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeHub:
+    """A tiny stand-in for the Dotscience hub, run on a local port.
+
+    Every request is recorded in self.requests as (method, path, headers,
+    body), and the client's address in self.clients. Responses come from
+    self.routes, a dict mapping (method, path) to either (status,
+    json_body[, headers]) or a function taking the request and returning
+    one; anything else gets 200 and an empty JSON object."""
+
+    def __init__(self):
+        self.requests = []
+        self.clients = []
+        self.routes = {}
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    body = b""
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                        if size == 0:
+                            return body
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _handle(self):
+                # Clients may send an absolute URI as the request target
+                if "://" in self.path:
+                    self.path = "/" + self.path.split("://", 1)[1].split("/", 1)[1]
+                req = (self.command, self.path, dict(self.headers), self._body())
+                hub.requests.append(req)
+                hub.clients.append(self.client_address)
+                route = hub.routes.get((self.command, self.path.split("?")[0]), (200, {}))
+                if callable(route):
+                    route = route(req)
+                status, body = route[0], route[1]
+                headers = route[2] if len(route) > 2 else {}
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except ConnectionError:
+                    # Some clients hang up without reading the response
+                    pass
+
+            do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % (self.server.server_address[1],)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def hub():
+    """A FakeHub, closed at the end of the test."""
+    hub = FakeHub()
+    yield hub
+    hub.close()
+
+class FakeDotmeshClient:
+    """Records commits made with getDot(...).getBranch(...).commit(...)
+    in self.commits as (dot, branch, message, metadata), and counts calls
+    to log() in self.logs."""
+
+    def __init__(self, cluster_url, username, api_key):
+        self.cluster_url = cluster_url
+        self.username = username
+        self.api_key = api_key
+        self.commits = []
+        self.logs = 0
+
+    def ping(self):
+        pass
+
+    def getDot(self, dotname, ns):
+        client = self
+
+        class Branch:
+            def __init__(self, name):
+                self.name = name
+
+            def commit(self, message, metadata):
+                client.commits.append((dotname, self.name, message, metadata))
+
+            def log(self):
+                client.logs += 1
+                return [{"Id": str(i), "Metadata": dict(metadata, message=message)}
+                        for i, (dot, branch, message, metadata) in enumerate(client.commits)
+                        if (dot, branch) == (dotname, self.name)]
+
+        class Dot:
+            def getBranch(self, name):
+                return Branch(name)
+
+        return Dot()
+
+def _connected_ds(monkeypatch, hub, **kwargs):
+    monkeypatch.setattr(dotscience, "DotmeshClient", FakeDotmeshClient)
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url, **kwargs)
+    ds._cached_project = {"id": "0123456789abcdef", "name": "myproj"}
+    return ds
+
+def _make_model_dir(files):
+    for name, content in files.items():
+        if os.path.dirname(name):
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(content)
+
+def test_stream_upload_archive(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({
+        "model/saved_model.pb": b"x" * 100,
+        "model/variables/variables.data-00000-of-00001": os.urandom(3 * 1024 * 1024 + 7),
+    })
+    def no_temp_files(*args, **kwargs):
+        raise AssertionError("streaming upload used a temporary file")
+    monkeypatch.setattr(dotscience.tempfile, "NamedTemporaryFile", no_temp_files)
+
+    ds = _connected_ds(monkeypatch, hub, upload_mode="stream")
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    ds._upload_output_files(ds.currentRun)
+
+    [(method, path, headers, body)] = hub.requests
+    assert method == "PUT"
+    assert path == "/v2/dotmesh/s3/me:project-01234567-default-workspace/model"
+    assert headers["Extract"] == "true"
+    assert headers["Transfer-Encoding"] == "chunked"
+    tar = tarfile.open(fileobj=io.BytesIO(body))
+    assert sorted(tar.getnames()) == ["saved_model.pb", "variables/variables.data-00000-of-00001"]
+    for name in tar.getnames():
+        with open(os.path.join("model", name), "rb") as f:
+            assert tar.extractfile(name).read() == f.read()
+
+def test_connect_rejects_unknown_upload_mode(monkeypatch):
+    monkeypatch.setattr(dotscience, "DotmeshClient", FakeDotmeshClient)
+    ds = dotscience.Dotscience()
+    try:
+        ds.connect("me", "pass", "myproj", "https://example.com", upload_mode="carrier-pigeon")
+    except RuntimeError:
+        pass
+    else:
+        assert False, "connect() accepted an unknown upload mode"
+
+def test_upload_files_concurrently(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    files = {"model/asset-%03d.txt" % (i,): ("asset %d" % (i,)).encode() for i in range(20)}
+    _make_model_dir(files)
+
+    ds = _connected_ds(monkeypatch, hub, upload_mode="files", upload_workers=8)
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    ds._upload_output_files(ds.currentRun)
+
+    prefix = "/v2/dotmesh/s3/me:project-01234567-default-workspace/"
+    uploaded = {path[len(prefix):]: body for (method, path, headers, body) in hub.requests}
+    assert all(method == "PUT" for (method, path, headers, body) in hub.requests)
+    assert uploaded == files
+
+def test_dedupe_skips_unchanged_outputs(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({
+        "model/saved_model.pb": b"graph",
+        "model/variables/variables.index": b"index",
+        "model/variables/variables.data": b"weights v1",
+    })
+
+    ds = _connected_ds(monkeypatch, hub, upload_mode="files", dedupe=True)
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    assert ds._upload_output_files(ds.currentRun) == {"uploaded_bytes": 20, "skipped_bytes": 0}
+    assert len(hub.requests) == 3
+
+    # Touching a file without changing it doesn't count as a change
+    os.utime("model/saved_model.pb", (0, 0))
+    with open("model/variables/variables.data", "wb") as f:
+        f.write(b"weights v2!")
+    hub.requests.clear()
+    assert ds._upload_output_files(ds.currentRun) == {"uploaded_bytes": 11, "skipped_bytes": 10}
+    [(method, path, headers, body)] = hub.requests
+    assert path.endswith("/model/variables/variables.data")
+    assert body == b"weights v2!"
+    assert os.path.exists(dotscience.UPLOAD_MANIFEST_FILE)
+
+def test_hub_connections_are_reused(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model/a": b"a", "model/b": b"b", "model/c": b"c"})
+
+    ds = _connected_ds(monkeypatch, hub, upload_mode="files", upload_workers=1)
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    ds._upload_output_files(ds.currentRun)
+    ds._upload_output_files(ds.currentRun)
+    # Every upload went over the same keep-alive connection
+    assert len(hub.requests) == 6
+    assert len(set(hub.clients)) == 1
+
+    hub.routes[("GET", "/v2/deployers")] = (200, [])
+    for _ in range(3):
+        try:
+            ds._deploy_to_kube(ds.currentRun, "image")
+        except Exception:
+            pass
+    assert len(set(hub.clients)) == 2
+
+    # Reconnecting starts a fresh pool, and closes the old one
+    session = ds._session
+    [conn] = ds._upload_connections
+    closed = []
+    monkeypatch.setattr(session, "close", lambda: closed.append(session))
+    monkeypatch.setattr(conn, "close", lambda: closed.append(conn))
+    ds.connect("me", "pass", "myproj", hub.url)
+    assert ds._session is not session
+    assert ds._upload_connections == []
+    assert closed == [session, conn]
+
+def test_upload_timeout(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model.pkl": b"pickle", "model/a": b"a", "model/b": b"b"})
+
+    # The hub takes longer than timeout to store each upload
+    prefix = "/v2/dotmesh/s3/me:project-01234567-default-workspace/"
+    def slow(req):
+        time.sleep(0.5)
+        return 200, {}
+    hub.routes[("PUT", prefix + "model.pkl")] = slow
+    hub.routes[("PUT", prefix + "model")] = slow
+    ds = _connected_ds(monkeypatch, hub, timeout=0.2, retry_attempts=1)
+    ds._upload("model.pkl")
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    ds._upload_output_files(ds.currentRun)
+    assert ds.hub_stats()["failures"] == 0
+    # but other calls still time out
+    hub.routes[("GET", "/v2/projects")] = slow
+    ds._cached_project = None
+    try:
+        ds._get_project_or_create("myproj")
+        assert False, "expected a timeout"
+    except Exception as e:
+        assert "timed out" in str(e), e
+
+    ds = _connected_ds(monkeypatch, hub, timeout=0.2, upload_timeout=0.1, retry_attempts=1)
+    for upload in [lambda: ds._upload("model.pkl"), lambda: ds._putArchive("model", lambda: b"tar")]:
+        try:
+            upload()
+            assert False, "expected a timeout"
+        except Exception as e:
+            assert "timed out" in str(e), e
+
+from urllib.parse import urlsplit, parse_qs
+
+class FakeS3Multipart:
+    """Serves the S3 multipart upload API for one object on a FakeHub.
+
+    fail_parts maps part numbers to how many times uploading them should
+    fail with a 500 before succeeding."""
+
+    def __init__(self, hub, path, fail_parts=None):
+        import hashlib
+        self.hashlib = hashlib
+        self.fail_parts = dict(fail_parts or {})
+        self.uploads = {}
+        self.part_puts = []
+        self.completed = None
+        hub.routes[("POST", path)] = self._post
+        hub.routes[("PUT", path)] = self._put
+
+    def _post(self, req):
+        method, path, headers, body = req
+        query = parse_qs(urlsplit(path).query, keep_blank_values=True)
+        if "uploads" in query:
+            upload_id = "upload-%d" % (len(self.uploads),)
+            self.uploads[upload_id] = {}
+            return 200, ('<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                         '<UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (upload_id,)).encode()
+        parts = self.uploads.get(query["uploadId"][0])
+        if parts is None:
+            return 404, b"NoSuchUpload"
+        numbers = [int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>", body.decode())]
+        self.completed = b"".join(parts[n] for n in numbers)
+        return 200, b"<CompleteMultipartUploadResult/>"
+
+    def _put(self, req):
+        import base64
+        method, path, headers, body = req
+        query = parse_qs(urlsplit(path).query)
+        n = int(query["partNumber"][0])
+        parts = self.uploads.get(query["uploadId"][0])
+        if parts is None:
+            return 404, b"NoSuchUpload"
+        self.part_puts.append(n)
+        if self.fail_parts.get(n, 0) > 0:
+            self.fail_parts[n] -= 1
+            return 500, b"oops"
+        md5 = self.hashlib.md5(body)
+        assert base64.b64decode(headers["Content-MD5"]) == md5.digest()
+        parts[n] = body
+        return 200, b"", {"ETag": '"%s"' % (md5.hexdigest(),)}
+
+def test_multipart_upload_resumes(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience.time, "sleep", lambda s: None)
+    content = os.urandom(10 * 1024 + 100)
+    _make_model_dir({"checkpoint.bin": content})
+
+    s3 = FakeS3Multipart(hub, "/v2/dotmesh/s3/me:project-01234567-default-workspace/checkpoint.bin",
+                         fail_parts={3: 10, 5: 1})
+    ds = _connected_ds(monkeypatch, hub, multipart_threshold=1024, multipart_part_size=1024)
+
+    # Part 3 fails more times than we retry, so the upload gives up...
+    try:
+        ds._upload("checkpoint.bin")
+    except Exception:
+        pass
+    else:
+        assert False, "upload should have failed"
+    assert s3.completed is None
+    assert sorted(set(s3.part_puts)) == list(range(1, 12))
+    # Each failed PUT is counted once
+    stats = ds.hub_stats()
+    assert (stats["failures"], stats["gave_up"]) == (11, 1)
+
+    # ...and the next attempt only sends the part that's missing
+    s3.part_puts.clear()
+    ds._upload("checkpoint.bin")
+    assert s3.part_puts == [3]
+    assert s3.completed == content
+    assert ds._load_multipart_state(hub.url + "/v2/dotmesh/s3/me:project-01234567-default-workspace/checkpoint.bin") is None
+
+def test_multipart_upload_restarts_when_hub_forgets(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    content = os.urandom(3000)
+    _make_model_dir({"checkpoint.bin": content})
+
+    s3 = FakeS3Multipart(hub, "/v2/dotmesh/s3/me:project-01234567-default-workspace/checkpoint.bin")
+    ds = _connected_ds(monkeypatch, hub, multipart_threshold=1024, multipart_part_size=1024)
+    url = hub.url + "/v2/dotmesh/s3/me:project-01234567-default-workspace/checkpoint.bin"
+    st = os.stat("checkpoint.bin")
+    ds._save_multipart_state(url, {"upload_id": "long-gone", "size": st.st_size, "mtime": st.st_mtime_ns,
+                                   "part_size": 1024, "parts": {"1": "x"}})
+    ds._upload("checkpoint.bin")
+    assert s3.completed == content
+
+def test_balanced_shards():
+    os.makedirs("test_balanced_shards.tmp", exist_ok=True)
+    try:
+        sizes = {"a": 900, "b": 500, "c": 400, "d": 300, "e": 100}
+        for name, size in sizes.items():
+            with open("test_balanced_shards.tmp/" + name, "wb") as f:
+                f.write(b"x" * size)
+        files = ["test_balanced_shards.tmp/" + name for name in sizes]
+        shards = dotscience._balanced_shards(files, 2)
+        assert sorted(f for shard in shards for f in shard) == files
+        totals = sorted(sum(os.path.getsize(f) for f in shard) for shard in shards)
+        assert totals == [1000, 1200]
+        # Never more shards than files
+        assert len(dotscience._balanced_shards(files[:2], 4)) == 2
+    finally:
+        shutil.rmtree("test_balanced_shards.tmp")
+
+def test_sharded_archive_upload(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    files = {"model/shard-%d" % (i,): os.urandom(1000 * (i + 1)) for i in range(9)}
+    _make_model_dir(files)
+
+    for mode in ["archive", "stream"]:
+        hub = FakeHub()
+        try:
+            ds = _connected_ds(monkeypatch, hub, upload_mode=mode, upload_shards=3)
+            ds.start()
+            ds.add_output("model")
+            ds.currentRun._model_dir = "model"
+            ds._upload_output_files(ds.currentRun)
+        finally:
+            hub.close()
+
+        assert len(hub.requests) == 3
+        members = {}
+        for (method, path, headers, body) in hub.requests:
+            assert method == "PUT"
+            assert path == "/v2/dotmesh/s3/me:project-01234567-default-workspace/model"
+            assert headers["Extract"] == "true"
+            tar = tarfile.open(fileobj=io.BytesIO(body))
+            for name in tar.getnames():
+                members["model/" + name] = tar.extractfile(name).read()
+        assert members == files
+
+def test_compressed_archive_upload(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "COMPRESSION_BLOCK_SIZE", 4096)
+    files = {"model/vocab-%d.txt" % (i,): ("word%d\n" % (i,)).encode() * 2000 for i in range(4)}
+    _make_model_dir(files)
+
+    for mode in ["archive", "stream"]:
+        hub = FakeHub()
+        try:
+            ds = _connected_ds(monkeypatch, hub, upload_mode=mode, compression="gzip")
+            ds.start()
+            ds.add_output("model")
+            ds.currentRun._model_dir = "model"
+            stats = ds._upload_output_files(ds.currentRun)
+        finally:
+            hub.close()
+
+        [(method, path, headers, body)] = hub.requests
+        assert headers["Content-Encoding"] == "gzip"
+        assert stats["compressed_bytes"] == len(body)
+        assert stats["raw_bytes"] > 5 * stats["compressed_bytes"]
+        # Lots of independently compressed blocks, which still read back as
+        # one tar.gz
+        assert body.count(b"\x1f\x8b\x08") > 10
+        tar = tarfile.open(fileobj=io.BytesIO(body), mode="r:gz")
+        assert {"model/" + name: tar.extractfile(name).read() for name in tar.getnames()} == files
+
+def test_pick_compression_level(monkeypatch):
+    sample = b"".join(b"line %d of some text\n" % (i,) for i in range(10000))
+    # Higher levels take longer, without relying on the real timings
+    clock = [0.0]
+    compress_block = dotscience._compress_block
+    def slow_compress_block(codec, level, block):
+        clock[0] += level
+        return compress_block(codec, level, block)
+    monkeypatch.setattr(dotscience, "_compress_block", slow_compress_block)
+    monkeypatch.setattr(dotscience.time, "perf_counter", lambda: clock[0])
+    # With a slow link, it's worth spending CPU on the best compression...
+    sizes = {level: len(dotscience._compress_block("gzip", level, sample)) for level in dotscience.COMPRESSION_LEVELS["gzip"]}
+    level = dotscience._pick_compression_level("gzip", sample, 1, 1.0)
+    assert sizes[level] == min(sizes.values())
+    # ...but not on a practically infinite one
+    assert dotscience._pick_compression_level("gzip", sample, 1, 1e15) == 1
+
+def test_zstd_compress_stream():
+    zstandard = pytest.importorskip("zstandard")
+    data = b"some very compressible data " * 100000
+    sizes = {}
+    compressed = b"".join(dotscience._compress_stream(iter([data]), "zstd", 3, 1e6, sizes))
+    assert sizes == {"raw_bytes": len(data), "compressed_bytes": len(compressed)}
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(compressed)[:len(data)] == data[:len(data)]
+
+def test_zero_copy_upload(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    content = os.urandom(2 * 1024 * 1024 + 3)
+    _make_model_dir({"model.bin": content, "empty.bin": b""})
+    calls = []
+    put = dotscience._put_file_zero_copy
+    def spy(conn, url, f, headers):
+        calls.append(url)
+        return put(conn, url, f, headers)
+    monkeypatch.setattr(dotscience, "_put_file_zero_copy", spy)
+
+    ds = _connected_ds(monkeypatch, hub)
+    ds._upload("model.bin")
+    ds._upload("empty.bin")
+    # Without sendfile, the file is sent from an mmap instead
+    monkeypatch.delattr(os, "sendfile")
+    ds._upload("model.bin")
+
+    assert len(calls) == 3
+    assert [body for (method, path, headers, body) in hub.requests] == [content, b"", content]
+
+def test_eager_background_upload(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    try:
+        ds = _connected_ds(monkeypatch, hub, upload_mode="files", eager_upload=True, eager_upload_interval=0.05)
+        ds.start()
+        ds.output("model")
+        ds.currentRun._model_dir = "model"
+        files = {"model/a": b"aaaa", "model/b": b"bbbbbb"}
+        _make_model_dir(files)
+
+        deadline = time.time() + 10
+        while len(hub.requests) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert sorted(body for (method, path, headers, body) in hub.requests) == sorted(files.values())
+
+        # Nothing left to upload at publish time...
+        stats = ds._upload_output_files(ds.currentRun)
+        assert stats["background_bytes"] == 10 and stats["uploaded_bytes"] == 0
+        assert len(hub.requests) == 2
+
+        # ...unless a file changed since it was uploaded
+        ds._watcher.stop()
+        with open("model/b", "wb") as f:
+            f.write(b"changed")
+        stats = ds._upload_output_files(ds.currentRun)
+        assert stats["background_bytes"] == 4 and stats["uploaded_bytes"] == 7
+        assert hub.requests[-1][1].endswith("/model/b") and hub.requests[-1][3] == b"changed"
+    finally:
+        ds._watcher.stop()
+
+def _apply_delta(base, delta, out):
+    # Rebuild a file from the file objects base (the current copy) and
+    # delta (a body in the DELTA_CONTENT_TYPE format), writing it to out.
+    # This is what the hub does with a delta upload.
+    manifest = json.loads(delta.readline())
+    block_size = manifest["block_size"]
+    base_signature = {"size": 0, "block_size": block_size, "blocks": []}
+    for buf in iter(lambda: base.read(block_size), b""):
+        base_signature["size"] += len(buf)
+        base_signature["blocks"].append(hashlib.sha256(buf).hexdigest())
+    if dotscience._signature_digest(base_signature) != manifest["base"]:
+        raise Exception("Delta doesn't apply to this file")
+    changed = set(manifest["changed"])
+    for i, expected in enumerate(manifest["blocks"]):
+        length = min(block_size, manifest["size"] - i * block_size)
+        if i in changed:
+            buf = delta.read(length)
+        else:
+            base.seek(i * block_size)
+            buf = base.read(length)
+        if hashlib.sha256(buf).hexdigest() != expected:
+            raise Exception("Block %d doesn't match its signature" % (i,))
+        out.write(buf)
+
+class FakeObjectStore:
+    """Stores whole-file PUTs to one path on a FakeHub, and applies delta
+    uploads to them."""
+
+    def __init__(self, hub, path, takes_deltas=True):
+        self.content = None
+        self.takes_deltas = takes_deltas
+        hub.routes[("PUT", path)] = self._put
+
+    def _put(self, req):
+        method, path, headers, body = req
+        if headers.get("Content-Type") != dotscience.DELTA_CONTENT_TYPE or not self.takes_deltas:
+            self.content = body
+            return 200, {}
+        if self.content is None:
+            return 409, b"Nothing to apply a delta to"
+        out = io.BytesIO()
+        try:
+            _apply_delta(io.BytesIO(self.content), io.BytesIO(body), out)
+        except Exception as e:
+            return 409, str(e).encode()
+        self.content = out.getvalue()
+        return 200, {}, {dotscience.DELTA_APPLIED_HEADER: "applied"}
+
+def test_delta_sync(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    block = 1024
+    content = bytearray(os.urandom(10 * block))
+    _make_model_dir({"variables.data": bytes(content)})
+
+    store = FakeObjectStore(hub, "/v2/dotmesh/s3/me:project-01234567-default-workspace/variables.data")
+    ds = _connected_ds(monkeypatch, hub, delta_sync=True, delta_block_size=block)
+
+    # The first upload has nothing to compare against
+    ds._upload("variables.data")
+    assert store.content == content
+    assert len(hub.requests[-1][3]) == len(content)
+
+    # Only changed blocks are sent after that, including new ones
+    content[3 * block + 10] ^= 0xff
+    content[7 * block] ^= 0xff
+    content += b"more"
+    _make_model_dir({"variables.data": bytes(content)})
+    ds._upload("variables.data")
+    assert store.content == content
+    sent = hub.requests[-1][3]
+    assert sent.split(b"\n", 1)[1] == content[3 * block:4 * block] + content[7 * block:8 * block] + b"more"
+
+    # If the hub's copy isn't what we think it is, the whole file goes
+    store.content = b"something else"
+    content[0] ^= 0xff
+    _make_model_dir({"variables.data": bytes(content)})
+    ds._upload("variables.data")
+    assert store.content == content
+    assert hub.requests[-2][2]["Content-Type"] == dotscience.DELTA_CONTENT_TYPE
+    assert hub.requests[-1][3] == content
+
+    # A hub that doesn't say it applied the delta may have stored it as
+    # the file, so the whole file goes over it, and no more deltas
+    store.takes_deltas = False
+    content[0] ^= 0xff
+    _make_model_dir({"variables.data": bytes(content)})
+    ds._upload("variables.data")
+    assert store.content == content
+    assert hub.requests[-2][2]["Content-Type"] == dotscience.DELTA_CONTENT_TYPE
+    content[0] ^= 0xff
+    _make_model_dir({"variables.data": bytes(content)})
+    del hub.requests[:]
+    ds._upload("variables.data")
+    assert store.content == content
+    assert [r[3] for r in hub.requests] == [content]
+
+def test_output_policies(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({
+        "model/saved_model.pb": b"graph",
+        "model/variables/variables.data": b"w" * 100,
+        "model/__pycache__/junk.pyc": b"junk",
+        "model/events.out.tfevents.1234": b"events",
+        "model/tmp/ckpt-1/state": b"temp",
+        "logs/huge.log": b"l" * 1000,
+        "logs/small.log": b"l",
+        "logs/notes.txt": b"notes",
+    })
+    listed = []
+    listdir = os.listdir
+    def spy(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, "listdir", spy)
+
+    r = dotscience.Run(str(tmp_path))
+    r.add_output("model", exclude=["__pycache__", "*.tfevents.*", "tmp"])
+    r.add_output("logs", include="*.log", max_file_size=100)
+    assert r.metadata()["output"] == [
+        "logs/small.log",
+        "model/saved_model.pb",
+        "model/variables/variables.data",
+    ]
+    # Excluded directories are never even looked into
+    assert not any("__pycache__" in p or "tmp" in os.path.relpath(p, str(tmp_path)) for p in listed)
+
+    # Publish-time policies apply on top
+    r.set_output_policy(exclude="variables")
+    assert r.metadata()["output"] == ["logs/small.log", "model/saved_model.pb"]
+    r.set_output_policy(max_total_size=5)
+    try:
+        r.metadata()
+    except RuntimeError:
+        pass
+    else:
+        assert False, "max_total_size wasn't enforced"
+
+def test_publish_output_policy(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"out/keep.csv": b"1", "out/drop.tmp": b"2"})
+    ds = dotscience.Dotscience()
+    ds.script(TEST_WORKLOAD_FILE)
+    ds.start()
+    ds.output("out")
+    s = io.StringIO()
+    ds.publish(stream=s, exclude="*.tmp")
+    assert _parse(s.getvalue())["output"] == ["out/keep.csv"]
+    s = io.StringIO()
+    ds.publish(stream=s)
+    assert _parse(s.getvalue())["output"] == ["out/drop.tmp", "out/keep.csv"]
+
+def _fake_build_routes(hub, ds, release=None):
+    # Serves a model for each run committed so far, whose build completes
+    # once the release event (if any) is set
+    def models(req):
+        runs = [r for (dot, branch, message, metadata) in ds._dotmesh_client.commits for r in json.loads(metadata["runs"])]
+        return 200, [{"id": "model-%d" % (i,), "run_id": r} for i, r in enumerate(runs)]
+    hub.routes[("GET", "/v2/models")] = models
+    for i in range(8):
+        hub.routes[("POST", "/v2/models/model-%d/builds" % (i,))] = (201, {"id": "build-1", "image_name": "image-%d" % (i,)})
+        hub.routes[("GET", "/v2/models/model-%d/builds/build-1" % (i,))] = \
+            lambda req: (200, {"status": "completed" if release is None or release.is_set() else "running"})
+
+def test_publish_without_waiting(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = _connected_ds(monkeypatch, hub)
+    release = threading.Event()
+    _fake_build_routes(hub, ds, release)
+
+    ds.start()
+    ds.output("model.pkl")
+    ds.add_metric("accuracy", 0.5)
+    handle = ds.publish("trial 1", build=True, wait=False)
+    # The caller can get on with the next trial while the build runs
+    ds.add_metric("accuracy", 0.9)
+    deadline = time.time() + 10
+    while handle.state != "building" and time.time() < deadline:
+        time.sleep(0.01)
+    assert not handle.done()
+    assert handle.run == "%s/project/0123456789abcdef/runs/metric/%s" % (hub.url, handle.run_id)
+    assert handle.image is None
+
+    # The next trial queues behind it, with the outputs it had when it
+    # was published, not ones written while it waits
+    _make_model_dir({"logs/trial-2.txt": b"log"})
+    ds.start()
+    ds.output("logs")
+    ds.currentRun._model_dir = "logs"
+    queued = ds.publish("trial 2", wait=False)
+    _make_model_dir({"logs/trial-3.txt": b"log"})
+    assert queued.state == "queued"
+
+    release.set()
+    ret = handle.result(timeout=30)
+    assert handle.state == "done"
+    assert ret["image"] == handle.image == "image-0"
+    assert ret["run"] == handle.run
+    queued.result(timeout=30)
+    [(_, _, _, metadata), (_, _, _, queued_metadata)] = ds._dotmesh_client.commits
+    assert metadata["run.%s.summary.accuracy" % (handle.run_id,)] == "0.5"
+    assert json.loads(queued_metadata["run.%s.output-files" % (queued.run_id,)]) == ["logs/trial-2.txt"]
+
+def test_publish_without_waiting_failure(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    ds = _connected_ds(monkeypatch, hub)
+    def broken_commit(run):
+        raise RuntimeError("hub says no")
+    monkeypatch.setattr(ds, "_commit_run_on_hub", broken_commit)
+    ds.start()
+    handle = ds.publish(wait=False)
+    assert isinstance(handle.exception(timeout=30), RuntimeError)
+    assert handle.state == "failed"
+
+def test_async_publish(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "DotmeshClient", FakeDotmeshClient)
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = dotscience.Dotscience()
+    release = threading.Event()
+    _fake_build_routes(hub, ds, release)
+    expanded_on = []
+    add_output_path = dotscience._add_output_path
+    def recording_add_output_path(*args, **kwargs):
+        expanded_on.append(threading.current_thread())
+        return add_output_path(*args, **kwargs)
+    monkeypatch.setattr(dotscience, "_add_output_path", recording_add_output_path)
+
+    async def main():
+        # Publishes overlap without asking for more publish_workers
+        await ds.aconnect("me", "pass", "myproj", hub.url)
+        ds._cached_project = {"id": "0123456789abcdef", "name": "myproj"}
+        publishes = []
+        for trial in range(2):
+            ds.start()
+            ds.output("model.pkl")
+            ds.add_metric("trial", trial)
+            publishes.append(asyncio.ensure_future(ds.apublish("trial %d" % (trial,), build=True)))
+            await asyncio.sleep(0)
+        # Both builds get started while the loop carries on running
+        ticks = 0
+        try:
+            while len([r for r in hub.requests if r[0] == "POST" and r[1].endswith("/builds")]) < 2:
+                ticks += 1
+                assert ticks < 1000, "builds weren't started concurrently"
+                await asyncio.sleep(0.01)
+            assert not any(p.done() for p in publishes)
+        finally:
+            release.set()
+        return ticks, await asyncio.wait_for(asyncio.gather(*publishes), 30)
+
+    ticks, results = asyncio.run(main())
+    assert ticks > 0
+    assert sorted(r["image"] for r in results) == ["image-0", "image-1"]
+    assert len(ds._dotmesh_client.commits) == 2
+    # The output files were found off the event loop
+    assert expanded_on and threading.main_thread() not in expanded_on
+
+def test_run_stages():
+    order = []
+    both_started = threading.Barrier(2, timeout=10)
+    def independent(name):
+        def stage(results):
+            # Deadlocks unless a and b run at the same time
+            both_started.wait()
+            order.append(name)
+            return name
+        return stage
+    results, timings = dotscience._run_stages({
+        "a": ((), independent("a")),
+        "b": ((), independent("b")),
+        "c": (("a", "b"), lambda results: results["a"] + results["b"]),
+    })
+    assert results == {"a": "a", "b": "b", "c": "ab"}
+    assert sorted(order) == ["a", "b"]
+    assert set(timings) == {"a", "b", "c"}
+
+    ran = []
+    def broken(results):
+        raise ValueError("stage failed")
+    try:
+        dotscience._run_stages({
+            "a": ((), broken),
+            "b": (("a",), lambda results: ran.append("b")),
+            "c": (("b",), lambda results: ran.append("c")),
+            "d": ((), lambda results: ran.append("d")),
+            "e": (("d",), lambda results: ran.append("e")),
+        })
+        assert False, "expected the stage's error to be raised"
+    except ValueError:
+        pass
+    # Only the stages that don't need the broken one ran
+    assert ran == ["d", "e"]
+
+def test_publish_commits_without_deployers(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = _connected_ds(monkeypatch, hub)
+    _fake_build_routes(hub, ds)
+    # Deployers are listed while the upload is still going
+    def slow_upload(req):
+        time.sleep(0.5)
+        return 200, {}
+    hub.routes[("PUT", "/v2/dotmesh/s3/me:project-01234567-default-workspace/model.pkl")] = slow_upload
+    hub.routes[("GET", "/v2/deployers")] = (200, [])
+
+    ds.start()
+    ds.output("model.pkl")
+    try:
+        ds.publish("trained", deploy=True)
+        assert False, "expected the deploy to fail"
+    except Exception as e:
+        assert "no online deployers" in str(e), e
+    # The run is committed and built all the same
+    [(dot, branch, message, metadata)] = ds._dotmesh_client.commits
+    assert json.loads(metadata["runs"]) == [ds.currentRun._id]
+    assert [r[1] for r in hub.requests if r[0] == "POST" and r[1].endswith("/builds")] == ["/v2/models/model-0/builds"]
+
+def test_publish_overlaps_stages(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DOTSCIENCE_MODEL_URL_SCHEME", "http")
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = _connected_ds(monkeypatch, hub, build_timeout=5)
+    # The build only finishes once deployers have been listed, which
+    # takes a while, so this only succeeds if the two happen at the
+    # same time
+    listed = threading.Event()
+    _fake_build_routes(hub, ds, listed)
+    host = hub.url.split("://")[1]
+    def deployers(req):
+        time.sleep(0.3)
+        listed.set()
+        return 200, [{"id": "offline", "status": "offline"}, {"id": "d1", "status": "online"}]
+    hub.routes[("GET", "/v2/deployers")] = deployers
+    hub.routes[("POST", "/v2/deployers/d1/deployments")] = (201, {"id": "dep1", "host": host})
+    hub.routes[("POST", "/v2/deployers/d1/deployments/dep1/dashboard")] = (201, {"dashboardURL": "http://grafana/d/1"})
+    # The endpoint only comes up once the dashboard has been asked for,
+    # so this only finishes if the two happen at the same time
+    hub.routes[("GET", "/v1/models/model")] = lambda req: (
+        200 if any(r[1].endswith("/dashboard") for r in hub.requests) else 503, {})
+
+    ds.start()
+    ds.output("model.pkl")
+    ret = ds.publish("trained", deploy=True)
+    assert ret["image"] == "image-0"
+    assert ret["endpoint"] == "http://%s/v1/models/model:predict" % (host,)
+    assert ret["dashboard"] == "http://grafana/d/1"
+    timings = dict(ret["timings"])
+    total = timings.pop("total")
+    assert set(timings) == {"project", "upload", "commit", "build", "deployer", "deploy", "dashboard", "wait_active"}
+    # Overlapping stages took longer between them than the publish did
+    assert total < sum(timings.values())
+    assert timings["build"] >= 0.2 and timings["deployer"] >= 0.3
+
+def test_publish_updates_deployment(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DOTSCIENCE_MODEL_URL_SCHEME", "http")
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = _connected_ds(monkeypatch, hub, build_cache=False)
+    _fake_build_routes(hub, ds)
+    host = hub.url.split("://")[1]
+    hub.routes[("GET", "/v2/deployers")] = (200, [{"id": "d1", "status": "online"}])
+    hub.routes[("GET", "/v2/deployers/d1/deployments")] = (200, [])
+    hub.routes[("POST", "/v2/deployers/d1/deployments")] = (201, {"id": "dep1", "name": "myproj", "host": host})
+    hub.routes[("PUT", "/v2/deployers/d1/deployments/dep1")] = (200, {"id": "dep1", "name": "myproj", "host": host})
+    hub.routes[("POST", "/v2/deployers/d1/deployments/dep1/dashboard")] = (201, {"dashboardURL": "http://grafana/d/1"})
+    hub.routes[("GET", "/v2/deployers/d1/deployments/dep1/dashboard")] = (200, {"dashboardURL": "http://grafana/d/1"})
+    hub.routes[("GET", "/v1/models/model")] = (200, {})
+
+    ds.start()
+    ds.output("model.pkl")
+    ret = ds.publish("first", deploy=True)
+    assert ret["deployment"] == "created"
+    assert 0 < ret["time_to_serving"] <= ret["timings"]["total"]
+
+    # Once the deployment exists, later publishes roll the new image out
+    # to it and keep its dashboard
+    hub.routes[("GET", "/v2/deployers/d1/deployments")] = (200, [{"id": "dep1", "name": "myproj", "host": host}])
+    del hub.requests[:]
+    ds.start()
+    ds.output("model.pkl")
+    ret = ds.publish("retrained", deploy=True)
+    assert ret["deployment"] == "updated"
+    assert ret["dashboard"] == "http://grafana/d/1"
+    assert ret["endpoint"] == "http://%s/v1/models/model:predict" % (host,)
+    [put] = [r for r in hub.requests if r[0] == "PUT" and r[1].startswith("/v2/deployers")]
+    assert json.loads(put[3])["image_name"] == "image-1"
+    assert [r for r in hub.requests if r[0] == "POST" and r[1].startswith("/v2/deployers")] == []
+    # Finding the deployer found the deployment too
+    assert [r[1] for r in hub.requests if r[0] == "GET" and r[1].endswith("/deployments")] == ["/v2/deployers/d1/deployments"]
+
+def test_pick_deployer():
+    deployers = [
+        {"id": "a", "status": "online", "load": 0.9, "capacity": 10},
+        {"id": "b", "status": "online", "load": "0.2"},
+        {"id": "c", "status": "online", "capacity": 3},
+    ]
+    assert dotscience._pick_deployer(deployers, 0)["id"] == "b"
+    assert dotscience._pick_deployer(deployers[2:] + [{"id": "d", "capacity": 5}], 0)["id"] == "d"
+    # With nothing to go on, new deployments go to each in turn
+    unknown = [{"id": "y"}, {"id": "x"}]
+    assert [dotscience._pick_deployer(unknown, turn)["id"] for turn in range(3)] == ["x", "y", "x"]
+
+def test_deploy_scaling(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DOTSCIENCE_MODEL_URL_SCHEME", "http")
+    _make_model_dir({"model.pkl": b"pickle"})
+    try:
+        _connected_ds(monkeypatch, hub, min_replicas=3, max_replicas=2)
+        assert False, "expected min_replicas > max_replicas to be refused"
+    except RuntimeError:
+        pass
+    ds = _connected_ds(monkeypatch, hub, cpu_request="500m", memory_request="1Gi",
+                       min_replicas=2, max_replicas=8, target_cpu_utilization=70)
+    _fake_build_routes(hub, ds)
+    host = hub.url.split("://")[1]
+    deployers = [
+        {"id": "busy", "status": "online", "load": 0.8},
+        {"id": "idle", "status": "online", "load": 0.1},
+        {"id": "down", "status": "offline", "load": 0.0},
+    ]
+    hub.routes[("GET", "/v2/deployers")] = (200, deployers)
+    for d in deployers:
+        hub.routes[("GET", "/v2/deployers/%s/deployments" % (d["id"],))] = (200, [])
+        hub.routes[("POST", "/v2/deployers/%s/deployments" % (d["id"],))] = (201, {"id": "dep-" + d["id"], "name": "myproj", "host": host})
+        hub.routes[("POST", "/v2/deployers/%s/deployments/dep-%s/dashboard" % (d["id"], d["id"]))] = (201, {"dashboardURL": "http://grafana/d/1"})
+    hub.routes[("GET", "/v1/models/model")] = (200, {})
+
+    ds.start()
+    ds.output("model.pkl")
+    ds.publish("trained", deploy=True)
+    [post] = [r for r in hub.requests if r[0] == "POST" and r[1].endswith("/deployments")]
+    assert post[1] == "/v2/deployers/idle/deployments"
+    body = json.loads(post[3])
+    assert body["replicas"] == 2
+    assert body["resources"] == {"requests": {"cpu": "500m", "memory": "1Gi"}}
+    assert body["autoscaling"] == {"min_replicas": 2, "max_replicas": 8, "target_cpu_utilization": 70}
+
+    # The deployer with our deployment keeps it, however busy it is
+    hub.routes[("GET", "/v2/deployers/busy/deployments")] = (200, [{"id": "dep-busy", "name": "myproj", "host": host}])
+    deployer, existing = ds._find_deployer()
+    assert (deployer["id"], existing["id"]) == ("busy", "dep-busy")
+
+    # Deployers that don't report their load take turns, even between
+    # processes that only deploy once each
+    hub.routes[("GET", "/v2/deployers/busy/deployments")] = (200, [])
+    for d in deployers:
+        del d["load"]
+    def deploy():
+        ds = _connected_ds(monkeypatch, hub)
+        ds.start()
+        return ds._deploy_to_kube(ds.currentRun, "image")[0]["id"]
+    picked = [deploy() for i in range(3)]
+    assert sorted(picked[:2]) == ["busy", "idle"] and picked[2] == picked[0]
+
+    # A deploy that fails doesn't use up a deployer's turn
+    route = ("POST", "/v2/deployers/%s/deployments" % (picked[1],))
+    created = hub.routes[route]
+    hub.routes[route] = (500, b"broken")
+    try:
+        deploy()
+        assert False, "expected the deploy to fail"
+    except Exception as e:
+        assert "500" in str(e), e
+    hub.routes[route] = created
+    assert deploy() == picked[1]
+
+def test_wait_for_backs_off(monkeypatch):
+    clock = [1000.0]
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(dotscience.time, "time", lambda: clock[0])
+    monkeypatch.setattr(dotscience.time, "sleep", sleep)
+    ds = dotscience.Dotscience()
+    ds._poll_max_interval = 1.0
+
+    # Something that's ready quickly is noticed quickly...
+    calls = []
+    def ready_third_time():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Exception("not yet")
+        return "ready"
+    assert ds._wait_for("get ready", ready_third_time, clock[0] + 60) == "ready"
+    assert sum(sleeps) <= 3 * dotscience.POLL_MIN_INTERVAL
+
+    # ...something slow isn't checked more than every poll_max_interval...
+    del sleeps[:]
+    try:
+        ds._wait_for("never", lambda: None, clock[0] + 30)
+        assert False, "expected a timeout"
+    except TimeoutError:
+        pass
+    # Waits double (give or take jitter) until they reach the maximum
+    assert sleeps[:5] == sorted(sleeps[:5])
+    assert max(sleeps) <= 1.0
+    assert len(sleeps) < 80
+    # ...and the caller's deadline is kept to
+    assert abs(sum(sleeps) - 30) < 1e-6
+
+def test_build_status_subscription(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    ds = _connected_ds(monkeypatch, hub, status_subscribe=True)
+    ds.start()
+    run = ds.currentRun
+    hub.routes[("GET", "/v2/models")] = (200, [{"id": "model-0", "run_id": run._id}])
+    hub.routes[("POST", "/v2/models/model-0/builds")] = (201, {"id": "build-1", "image_name": "image-0"})
+    events = b"".join(b"data: %s\n\n" % (json.dumps({"id": "build-1", "status": s}).encode("utf-8"),)
+                      for s in ["queued", "running", "completed"])
+    hub.routes[("GET", "/v2/models/model-0/builds/build-1")] = (200, events, {"Content-Type": "text/event-stream"})
+    assert ds._build_docker_image_on_hub(run) == "image-0"
+    [status] = [r for r in hub.requests if r[1].endswith("/builds/build-1")]
+    assert status[2]["Accept"].startswith("text/event-stream")
+
+    # A hub that doesn't stream just gets polled
+    polls = []
+    def poll(req):
+        polls.append(req)
+        return 200, {"id": "build-1", "status": "completed" if len(polls) == 3 else "running"}
+    hub.routes[("GET", "/v2/models/model-0/builds/build-1")] = poll
+    assert ds._build_docker_image_on_hub(run) == "image-0"
+    assert len(polls) == 3
+
+    hub.routes[("GET", "/v2/models/model-0/builds/build-1")] = (200, {"id": "build-1", "status": "failed"})
+    try:
+        ds._build_docker_image_on_hub(run)
+        assert False, "expected the build to fail"
+    except Exception as e:
+        assert "Build failed" in str(e)
+
+def test_retry_policy(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model.pkl": b"pickle"})
+    ds = _connected_ds(monkeypatch, hub, retry_backoff=0.001)
+    path = "/v2/dotmesh/s3/me:project-01234567-default-workspace/model.pkl"
+
+    # The hub being busy is worth waiting for...
+    responses = [(423, b"locked by task-1"), (503, b"try later"), (200, b"")]
+    hub.routes[("PUT", path)] = lambda req: responses.pop(0)
+    ds._upload("model.pkl")
+    assert responses == []
+    assert ds.hub_stats()["retries"] == 2
+
+    # ...but being refused isn't
+    hub.routes[("PUT", path)] = (403, b"forbidden")
+    del hub.requests[:]
+    try:
+        ds._upload("model.pkl")
+        assert False, "expected the upload to fail"
+    except dotscience._HubError as e:
+        assert e.status == 403
+    assert len(hub.requests) == 1
+    stats = ds.hub_stats()
+    # (and connect()'s ping)
+    assert (stats["calls"], stats["failures"], stats["gave_up"]) == (5, 2, 0)
+
+    # Local errors aren't the hub's fault, so aren't retried or counted
+    # against it
+    del hub.requests[:]
+    try:
+        ds._upload("missing.pkl")
+        assert False, "expected the upload to fail"
+    except FileNotFoundError:
+        pass
+    assert hub.requests == []
+    assert ds.hub_stats()["failures"] == 2
+
+def test_dotmesh_calls_are_retried(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    from jsonrpcclient.exceptions import ReceivedNon2xxResponseError
+    ds = _connected_ds(monkeypatch, hub, retry_backoff=0.001)
+    ds.start()
+    ds.end()
+    errors = {"ping": [ReceivedNon2xxResponseError(503)], "log": [dotscience.requests.ConnectionError("reset")]}
+    def flaky(name, fn):
+        def call(*args):
+            if errors.get(name):
+                raise errors[name].pop(0)
+            return fn(*args)
+        return call
+    ds._dotmesh_client.ping = flaky("ping", ds._dotmesh_client.ping)
+    branch = ds._master_branch("project-01234567-default-workspace")
+    branch.log = flaky("log", branch.log)
+    branch.commit = flaky("commit", branch.commit)
+
+    # Lookups are tried again...
+    ds._warm_up_now()
+    assert errors["ping"] == []
+
+    # ...and so is a commit that can't have got to the hub...
+    errors["commit"] = [dotscience.requests.ConnectionError("refused")]
+    ds._commit_run_on_hub(ds.currentRun)
+    assert len(ds._dotmesh_client.commits) == 1
+    assert ds._publish_entries([ds._spool_entry(ds.currentRun, False, False)]) == [None]
+    assert errors == {"ping": [], "log": [], "commit": []}
+    assert ds.hub_stats()["retries"] == 3
+
+    # ...but not one that might have
+    for error in [ReceivedNon2xxResponseError(502), dotscience.requests.ReadTimeout("timed out")]:
+        errors["commit"] = [error]
+        try:
+            ds._commit_run_on_hub(ds.currentRun)
+            assert False, "expected the commit to fail"
+        except (dotscience._HubError, dotscience.requests.ReadTimeout):
+            pass
+    assert len(ds._dotmesh_client.commits) == 1
+    assert ds.hub_stats()["gave_up"] == 2
+
+def test_circuit_breaker(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    files = ["model/asset-%02d.txt" % (i,) for i in range(20)]
+    _make_model_dir({f: b"asset" for f in files})
+    for f in files:
+        hub.routes[("PUT", "/v2/dotmesh/s3/me:project-01234567-default-workspace/" + f)] = (500, b"broken")
+    ds = _connected_ds(monkeypatch, hub, upload_mode="files", upload_workers=4, retry_backoff=0.01,
+                       breaker_threshold=6, breaker_cooldown=60)
+    ds.start()
+    ds.add_output("model")
+    ds.currentRun._model_dir = "model"
+    try:
+        ds._upload_output_files(ds.currentRun)
+        assert False, "expected the upload to fail"
+    except dotscience.HubUnavailable:
+        pass
+    stats = ds.hub_stats()
+    assert stats["breaker_opened"] >= 1
+    # Nothing like the 200 tries the uploads would have made between them
+    assert len(hub.requests) < 20
+    assert stats["short_circuited"] > 0
+
+    # Everything else fails fast until the cooldown is over
+    started = time.time()
+    try:
+        ds._find_deployer()
+        assert False, "expected the breaker to be open"
+    except dotscience.HubUnavailable:
+        pass
+    assert time.time() - started < 1
+
+def test_project_cache(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "DotmeshClient", FakeDotmeshClient)
+    _make_model_dir({"model.pkl": b"pickle"})
+    projects = [{"id": "fedcba9876543210", "name": "other"}, {"id": "0123456789abcdef", "name": "myproj"}]
+    hub.routes[("GET", "/v2/projects")] = (200, projects)
+    def lookups():
+        return [r for r in hub.requests if r[1].startswith("/v2/projects")]
+
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url)
+    assert ds._get_project_or_create("myproj")["id"] == "0123456789abcdef"
+    [(method, path, headers, body)] = lookups()
+    assert path == "/v2/projects?name=myproj"
+
+    # Another process connecting to the same hub as the same user finds
+    # it in the cache...
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url)
+    assert ds._get_project_or_create("myproj")["id"] == "0123456789abcdef"
+    assert len(lookups()) == 1
+    # ...unless it's too old
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url, project_cache_ttl=0.01)
+    time.sleep(0.02)
+    assert ds._get_project_or_create("myproj")["id"] == "0123456789abcdef"
+    assert len(lookups()) == 2
+    # Other users don't share it
+    ds = dotscience.Dotscience()
+    ds.connect("you", "pass", "myproj", hub.url)
+    ds._get_project_or_create("myproj")
+    assert len(lookups()) == 3
+
+    # If the hub says the project we have cached doesn't exist, it's
+    # looked up again
+    projects[1] = {"id": "5555555555555555", "name": "myproj"}
+    stale = "/v2/dotmesh/s3/me:project-01234567-default-workspace/model.pkl"
+    hub.routes[("PUT", stale)] = (404, b"no such dot")
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url)
+    ds.start()
+    ds.output("model.pkl")
+    ds.publish("trained")
+    puts = [r[1] for r in hub.requests if r[0] == "PUT"]
+    assert puts == [stale, "/v2/dotmesh/s3/me:project-55555555-default-workspace/model.pkl"]
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url)
+    assert ds._get_project_or_create("myproj")["id"] == "5555555555555555"
+
+def test_model_index(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "_model_indexes", {})
+    models = [{"id": "model-%d" % (i,), "run_id": "run-%d" % (i,)} for i in range(1000)]
+    # A hub that ignores the run_id query, but supports ETags
+    def list_models(req):
+        etag = '"v%d"' % (len(models),)
+        if req[2].get("If-None-Match") == etag:
+            return 304, b"", {"ETag": etag}
+        return 200, models, {"ETag": etag}
+    hub.routes[("GET", "/v2/models")] = list_models
+    ds = _connected_ds(monkeypatch, hub)
+    deadline = time.time() + 10
+    assert ds._find_model_id("run-500", deadline) == "model-500"
+    # Models we've already seen are found without asking again, from
+    # other Dotscience objects too
+    other = _connected_ds(monkeypatch, hub)
+    assert other._find_model_id("run-7", deadline) == "model-7"
+    assert len(hub.requests) == 1
+
+    # A model that isn't there yet costs a 304 per check until it appears
+    def appear(seconds):
+        if len(hub.requests) == 3:
+            models.append({"id": "model-new", "run_id": "run-new"})
+    monkeypatch.setattr(dotscience.time, "sleep", appear)
+    assert ds._find_model_id("run-new", deadline) == "model-new"
+    assert [r[2].get("If-None-Match") for r in hub.requests[1:]] == ['"v1000"', '"v1000"', '"v1000"']
+    assert len(hub.requests) == 4
+
+    # A hub that takes the query just sends the model we want
+    monkeypatch.setattr(dotscience, "_model_indexes", {})
+    del hub.requests[:]
+    hub.routes[("GET", "/v2/models")] = lambda req: (200, [m for m in models if "run_id=run-9" in req[1] and m["run_id"] == "run-9"])
+    assert ds._find_model_id("run-9", deadline) == "model-9"
+    [(method, path, headers, body)] = hub.requests
+    assert path == "/v2/models?run_id=run-9"
+    assert "If-None-Match" not in headers
+
+def test_lazy_connect(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model.pkl": b"pickle"})
+    pinged = threading.Event()
+    ping_error = []
+    class SlowDotmeshClient(FakeDotmeshClient):
+        dots = []
+        def ping(self):
+            pinged.wait(10)
+            if ping_error:
+                raise ping_error[0]
+        def getDot(self, dotname, ns):
+            self.dots.append(dotname)
+            return super().getDot(dotname, ns)
+    monkeypatch.setattr(dotscience, "DotmeshClient", SlowDotmeshClient)
+    hub.routes[("GET", "/v2/projects")] = (200, [{"id": "0123456789abcdef", "name": "myproj"}])
+    ds = dotscience.Dotscience()
+    started = time.time()
+    ds.connect("me", "pass", "myproj", hub.url, lazy=True)
+    assert time.time() - started < 1
+    assert hub.requests == []
+
+    # The project and dot are looked up once the hub answers, and
+    # publishing uses them
+    pinged.set()
+    ds._warm_up.result(10)
+    assert [r[1] for r in hub.requests] == ["/v2/projects?name=myproj"]
+    assert SlowDotmeshClient.dots == ["project-01234567-default-workspace"]
+    ds.start()
+    ds.output("model.pkl")
+    ds.publish("trained")
+    assert len(ds._dotmesh_client.commits) == 1
+    assert SlowDotmeshClient.dots == ["project-01234567-default-workspace"]
+
+    # If the hub can't be reached, it's publishing that fails
+    ping_error.append(RuntimeError("no route to hub"))
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url, lazy=True)
+    ds.start()
+    try:
+        ds.publish("trained")
+        assert False, "expected publish to fail"
+    except RuntimeError as e:
+        assert "no route to hub" in str(e)
+
+    # If it's back by the time we publish, publishing just works
+    ds = dotscience.Dotscience()
+    ds.connect("me", "pass", "myproj", hub.url, lazy=True)
+    assert ds._warm_up.exception(10) is not None
+    ping_error.clear()
+    ds.start()
+    ds.output("model.pkl")
+    ds.publish("trained")
+    assert len(ds._dotmesh_client.commits) == 1
+    assert ds._warm_up is None
+
+def test_spool(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "_model_indexes", {})
+    _make_model_dir({"model-a.pkl": b"a", "model-b.pkl": b"b"})
+    prefix = "/v2/dotmesh/s3/me:project-01234567-default-workspace/"
+    for f in ["model-a.pkl", "model-b.pkl"]:
+        hub.routes[("PUT", prefix + f)] = (503, b"down for maintenance")
+    commits = []
+    class SharedDotmeshClient(FakeDotmeshClient):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.commits = commits
+    ds = _connected_ds(monkeypatch, hub, spool=True, retry_attempts=2, retry_backoff=0.001)
+    monkeypatch.setattr(dotscience, "DotmeshClient", SharedDotmeshClient)
+    ds._dotmesh_client = SharedDotmeshClient(cluster_url=None, username="me", api_key="pass")
+    _fake_build_routes(hub, ds)
+
+    # While the hub's down, runs are saved in the spool
+    ds.start()
+    ds.output("model-a.pkl")
+    ds.add_metric("accuracy", 0.5)
+    ret = ds.publish("run a")
+    run_a = json.load(open(ret["spooled"]))["run_id"]
+    ds.start()
+    ds.output("model-b.pkl")
+    handle = ds.publish("run b", build=True, wait=False)
+    assert handle.result(10)["spooled"]
+    assert handle.state == "spooled"
+    assert commits == []
+    spooled = sorted(os.listdir(".dotscience-spool"))
+    assert spooled == sorted([run_a + ".json", handle.run_id + ".json"])
+    saved = open(os.path.join(".dotscience-spool", spooled[0])).read()
+
+    # Once it's back, they're uploaded and then committed together
+    for f in ["model-a.pkl", "model-b.pkl"]:
+        del hub.routes[("PUT", prefix + f)]
+    del hub.requests[:]
+    rets = ds.flush_spool()
+    [(dot, branch, message, metadata)] = commits
+    assert json.loads(metadata["runs"]) == [run_a, handle.run_id]
+    assert metadata["run.%s.summary.accuracy" % (run_a,)] == "0.5"
+    assert metadata["run.%s.description" % (handle.run_id,)] == "run b"
+    assert [r["run"].rsplit("/", 1)[1] for r in rets] == [run_a, handle.run_id]
+    assert "image" not in rets[0] and rets[1]["image"] == "image-1"
+    puts = [r[1] for r in hub.requests if r[0] == "PUT"]
+    assert puts == [prefix + "model-a.pkl", prefix + "model-b.pkl"]
+    assert os.listdir(".dotscience-spool") == []
+
+    # Flushing a run that was already published just drops it
+    with open(os.path.join(".dotscience-spool", spooled[0]), "w") as f:
+        f.write(saved)
+    from dotscience.__main__ import main
+    hub.routes[("GET", "/v2/projects")] = (200, [{"id": "0123456789abcdef", "name": "myproj"}])
+    monkeypatch.setattr(dotscience, "_defaultDS", ds)
+    assert main(["flush-spool", "--username", "me", "--apikey", "pass", "--project", "myproj", "--hostname", hub.url]) == 0
+    assert os.listdir(".dotscience-spool") == []
+    assert len(commits) == 1
+
+    # A run that's committed but fails to build stays in the spool, and
+    # isn't committed again however many commits there have been since
+    _make_model_dir({"model-c.pkl": b"c"})
+    hub.routes[("PUT", prefix + "model-c.pkl")] = (503, b"down for maintenance")
+    ds.connect("me", "pass", "myproj", hub.url, spool=True, retry_attempts=2, retry_backoff=0.001, build_timeout=1)
+    ds.start()
+    ds.output("model-c.pkl")
+    run_c = json.load(open(ds.publish("run c", build=True)["spooled"]))["run_id"]
+    del hub.routes[("PUT", prefix + "model-c.pkl")]
+    hub.routes[("POST", "/v2/models/model-2/builds")] = (400, b"can't build that")
+    try:
+        ds.flush_spool()
+        assert False, "expected the build to fail"
+    except Exception as e:
+        assert "can't build that" in str(e), e
+    assert json.loads(commits[1][3]["runs"]) == [run_c]
+    assert json.load(open(os.path.join(".dotscience-spool", run_c + ".json")))["committed"].endswith(run_c)
+    commits.append((dot, branch, "someone else's run", {"runs": json.dumps(["other"])}))
+    # Nor is one whose commit is further back
+    with open(os.path.join(".dotscience-spool", spooled[0]), "w") as f:
+        f.write(saved)
+    hub.routes[("POST", "/v2/models/model-2/builds")] = (201, {"id": "build-1", "image_name": "image-2"})
+    del hub.requests[:]
+    [ret] = ds.flush_spool()
+    assert ret["run"].endswith(run_c) and ret["image"] == "image-2"
+    assert [json.loads(c[3]["runs"]) for c in commits] == [[run_a, handle.run_id], [run_c], ["other"]]
+    assert [r for r in hub.requests if r[0] == "PUT"] == []
+    assert os.listdir(".dotscience-spool") == []
+
+def test_publisher_daemon(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "_model_indexes", {})
+    _make_model_dir({"vocab.txt": b"shared", "model-a.pkl": b"a", "model-b.pkl": b"b"})
+    hub.routes[("GET", "/v2/projects")] = (200, [{"id": "0123456789abcdef", "name": "myproj"}])
+    commits = []
+    class SharedDotmeshClient(FakeDotmeshClient):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.commits = commits
+    sock = str(tmp_path / "publisher.sock")
+    daemon = None
+    try:
+        trainers = [_connected_ds(monkeypatch, hub, publisher_socket=sock) for i in range(2)]
+        monkeypatch.setattr(dotscience, "DotmeshClient", SharedDotmeshClient)
+        for ds in trainers:
+            ds._dotmesh_client = SharedDotmeshClient(cluster_url=None, username="me", api_key="pass")
+        _fake_build_routes(hub, trainers[0])
+        daemon = dotscience.PublisherDaemon(sock, batch_window=0.5, upload_mode="files")
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+        assert os.stat(sock).st_mode & 0o777 == 0o600
+
+        # Requests it can't make sense of are turned away
+        for request in [b"not json\n", b"[]\n", b'{"root": "/"}\n']:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(sock)
+                client.sendall(request)
+                reply = json.loads(client.makefile("rb").readline())
+            assert reply["fallback"] and reply["error"].startswith("bad request: ")
+
+        # Trials finishing together are committed together, and the file
+        # they both output is only uploaded once
+        handles = []
+        for ds, name in zip(trainers, ["a", "b"]):
+            ds.start()
+            ds.output("vocab.txt")
+            ds.output("model-%s.pkl" % (name,))
+            handles.append(ds.publish("trial " + name, build=name == "b", wait=False))
+        rets = [h.result(10) for h in handles]
+        [(dot, branch, message, metadata)] = commits
+        assert dot == "project-01234567-default-workspace"
+        assert sorted(json.loads(metadata["runs"])) == sorted(h.run_id for h in handles)
+        assert [r["run"].rsplit("/", 1)[1] for r in rets] == [h.run_id for h in handles]
+        assert "image" not in rets[0] and rets[1]["image"].startswith("image-")
+        assert handles[1].state == "done" and handles[1].image == rets[1]["image"]
+        prefix = "/v2/dotmesh/s3/me:project-01234567-default-workspace/"
+        puts = [r[1] for r in hub.requests if r[0] == "PUT"]
+        assert sorted(puts) == [prefix + "model-a.pkl", prefix + "model-b.pkl", prefix + "vocab.txt"]
+        # and it doesn't need to look through the commit log to do it
+        assert [c._dotmesh_client.logs for c in daemon._clients.values()] == [0]
+
+        # Without a daemon, trials publish their runs themselves
+        daemon.close()
+        daemon = None
+        ds = trainers[0]
+        ds.start()
+        ds.output("model-a.pkl")
+        ret = ds.publish("trial c")
+        assert len(commits) == 2
+        assert json.loads(commits[1][3]["runs"]) == [ds.currentRun._id]
+        assert ret["run"].endswith(ds.currentRun._id)
+    finally:
+        if daemon is not None:
+            daemon.close()
+
+def test_build_cache(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(dotscience, "_model_indexes", {})
+    monkeypatch.delenv(dotscience.ENV_DOTSCIENCE_BUILDER, raising=False)
+    _make_model_dir({"model/saved_model.pb": b"v1", "model/variables/data": b"weights"})
+    ds = _connected_ds(monkeypatch, hub, retry_attempts=2, retry_backoff=0.001)
+    _fake_build_routes(hub, ds)
+    def publish():
+        ds.start()
+        ds.model(MockTensorflow(), "mnist", "model")
+        return ds.publish("trial", build=True)
+
+    assert publish()["image"] == "image-0"
+    # Publishing the same model again reuses its image
+    assert publish()["image"] == "image-0"
+    posts = [r[1] for r in hub.requests if r[0] == "POST" and r[1].endswith("/builds")]
+    assert posts == ["/v2/models/model-0/builds"]
+
+    # As the fingerprint covers the model's files, type, framework
+    # version and builder, changing any of them means a new build
+    fingerprint = dotscience._model_fingerprint(ds.currentRun)
+    monkeypatch.setenv(dotscience.ENV_DOTSCIENCE_BUILDER, "other-builder")
+    assert dotscience._model_fingerprint(ds.currentRun) != fingerprint
+    monkeypatch.delenv(dotscience.ENV_DOTSCIENCE_BUILDER)
+    ds.currentRun._labels["artefact:mnist"] = ds.currentRun._labels["artefact:mnist"].replace("1.2.3.4", "1.2.3.5")
+    assert dotscience._model_fingerprint(ds.currentRun) != fingerprint
+    _make_model_dir({"model/variables/data": b"better weights"})
+    assert publish()["image"] == "image-2"
+
+    # Images the hub no longer has aren't reused
+    hub.routes[("GET", "/v2/models/model-2/builds/build-1")] = (404, b"not found")
+    assert publish()["image"] == "image-3"
+    builds = json.load(open(tmp_path / "cache" / dotscience.BUILD_CACHE_FILE))
+    assert sorted(b["image"] for b in builds.values()) == ["image-0", "image-3"]
+
+    # Files that haven't changed aren't hashed again
+    hashed = []
+    sha256_file = dotscience._sha256_file
+    def counting_sha256_file(filename):
+        hashed.append(filename)
+        return sha256_file(filename)
+    monkeypatch.setattr(dotscience, "_sha256_file", counting_sha256_file)
+    assert publish()["image"] == "image-3"
+    assert hashed == []
+
+    # Only the files published with the run count
+    fingerprint = dotscience._model_fingerprint(ds.currentRun)
+    _make_model_dir({"model/train.log": b"epoch 1"})
+    ds.start()
+    ds.model(MockTensorflow(), "mnist", "model", exclude="*.log")
+    assert dotscience._model_fingerprint(ds.currentRun) == fingerprint
+
+    # If we can't check whether the hub still has the build, build it anyway
+    [build] = [b for b in json.load(open(tmp_path / "cache" / dotscience.BUILD_CACHE_FILE)).values() if b["image"] == "image-3"]
+    hub.routes[("GET", "/v2/models/%s/builds/%s" % (build["model_id"], build["build_id"]))] = (500, b"oops")
+    assert ds.publish("trial", build=True)["image"] == "image-5"
+
+def test_metadata_is_memoised(monkeypatch, tmp_path, hub):
+    monkeypatch.chdir(tmp_path)
+    _make_model_dir({"model/a": b"a", "model/b": b"b"})
+    expanded = []
+    add_output_path = dotscience._add_output_path
+    def counting_add_output_path(root, files, path, policies=(), top=None):
+        if top is None:
+            expanded.append(path)
+        return add_output_path(root, files, path, policies, top)
+    monkeypatch.setattr(dotscience, "_add_output_path", counting_add_output_path)
+
+    r = dotscience.Run(str(tmp_path))
+    r.add_output("model")
+    assert r.metadata()["output"] == ["model/a", "model/b"]
+    assert r.metadata() == r.metadata()
+    assert expanded == ["model"]
+    # Adding anything to the run means working it out again
+    r.add_metric("accuracy", 0.9)
+    assert r.metadata()["summary"] == {"accuracy": "0.9"}
+    assert expanded == ["model", "model"]
+
+    # One expansion is shared by the whole publish, which looks at the
+    # files afresh
+    _make_model_dir({"model/c": b"c"})
+    ds = _connected_ds(monkeypatch, hub)
+    ds.start()
+    ds.output("model")
+    ds.currentRun._model_dir = "model"
+    ds.currentRun.metadata()
+    _make_model_dir({"model/d": b"d"})
+    del expanded[:]
+    ds.publish("trained")
+    assert expanded == ["model"]
+    [(dot, branch, message, metadata)] = ds._dotmesh_client.commits
+    assert json.loads(metadata["run.%s.output-files" % (ds.currentRun._id,)]) == ["model/a", "model/b", "model/c", "model/d"]
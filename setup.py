@@ -16,6 +16,9 @@ setuptools.setup(
     install_requires=['datadots-api>=0.2.1', 'requests', "joblib==0.14.0"],
     tests_require=['pytest', 'hypothesis', 'datadots-api>=0.2.1'],
     zip_safe=True,
+    entry_points={
+        "console_scripts": ["dotscience=dotscience.__main__:main"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: Apache Software License",